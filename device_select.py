@@ -0,0 +1,130 @@
+import time
+import cv2
+import numpy as np
+import torch
+
+dnn_backends = { # Description, backend and target for each dnn backend setting
+    "cuda": ("CUDA", cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA),
+    "cuda_fp16": ("CUDA FP16", cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16),
+    "openvino": ("OpenVINO CPU", cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE, cv2.dnn.DNN_TARGET_CPU),
+    "openvino_gpu_fp16": ("OpenVINO GPU FP16", cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE, cv2.dnn.DNN_TARGET_OPENCL_FP16),
+    "opencl": ("OpenCL", cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_OPENCL),
+    "opencl_fp16": ("OpenCL FP16", cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_OPENCL_FP16),
+    "cpu": ("CPU", cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU),
+}
+dnn_backend = "auto" # Set with set_dnn_backend, "auto" tries full precision backends from fastest
+network_devices = {} # Backend chosen for each network with its latency, shown on page in stats
+
+
+def set_dnn_backend(backend):
+    """
+    Selects backend for OpenCV DNN networks initialized afterwards in this process
+    :param backend: "auto" or key of dnn_backends, plain CPU is used if it's not available
+    """
+    global dnn_backend
+    dnn_backend = backend
+
+
+def is_dnn_backend_available(backend, target):
+    """
+    :return: True if OpenCV DNN was built with backend and its device is present
+    """
+    if target not in cv2.dnn.getAvailableTargets(backend):
+        return False
+
+    if backend == cv2.dnn.DNN_BACKEND_CUDA:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+
+    if target in (cv2.dnn.DNN_TARGET_OPENCL, cv2.dnn.DNN_TARGET_OPENCL_FP16):
+        return cv2.ocl.haveOpenCL()
+
+    return True
+
+
+def get_dnn_candidates():
+    """
+    Probes backends and targets OpenCV DNN was built with and which devices are present
+    :return: list of (description, backend, target), selected or fastest first, plain CPU is always last
+    """
+    if dnn_backend == "auto":
+        names = ["cuda", "openvino", "opencl", "cpu"]
+    else:
+        names = [dnn_backend, "cpu"]
+
+    candidates = [dnn_backends[name] for name in dict.fromkeys(names)]
+
+    return [candidate for candidate in candidates if is_dnn_backend_available(candidate[1], candidate[2])]
+
+
+def run_test_pass(network, test_input):
+    # dnn_superres networks take images, cv2.dnn networks take blobs
+    if hasattr(network, "upsample"):
+        network.upsample(test_input)
+    else:
+        network.setInput(test_input)
+        network.forward()
+
+
+def select_dnn_backend(network, name, test_input):
+    """
+    Sets first backend that runs network, tried with a forward pass of test input,
+    some backends don't support all layers of a network
+    Second pass warms network up and measures its latency after first one compiled it
+    :param network: cv2.dnn network or dnn_superres upscaler
+    :param name: network name for stats, e.g. "yolo"
+    :param test_input: blob for cv2.dnn network or image for upscaler, of size network is used with
+    :return: network
+    """
+    for description, backend, target in get_dnn_candidates():
+        network.setPreferableBackend(backend)
+        network.setPreferableTarget(target)
+
+        try:
+            run_test_pass(network, test_input)
+        except cv2.error:
+            # Plain CPU runs all layers, so its errors are real ones
+            if description == "CPU":
+                raise
+            continue
+
+        start = time.perf_counter()
+        run_test_pass(network, test_input)
+        record_network_device(name, description, time.perf_counter() - start)
+
+        return network
+
+
+def select_torch_device(name):
+    """
+    :param name: network name for stats, e.g. "esrgan"
+    :return: CUDA device if there's a GPU, CPU otherwise
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    record_network_device(name, device.type.upper())
+
+    return device
+
+
+def record_network_device(name, description, latency=None):
+    """
+    Replaces stats of network device, e.g. with runtime and precision it runs in
+    :param latency: seconds of one test pass, None if not measured
+    """
+    network_devices[name] = {
+        "backend": description,
+        "latencyMs": None if latency is None else round(latency * 1000, 1),
+    }
+
+
+def get_network_devices():
+    """
+    :return: copy of backends chosen for networks of this process
+    """
+    return dict(network_devices)
+
+
+def get_blank_blob(width, height, channels=3):
+    """
+    :return: zero NCHW blob for backend test forward pass
+    """
+    return np.zeros((1, channels, height, width), np.float32)
@@ -0,0 +1,198 @@
+import os
+import queue
+import itertools
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedFrameRing:
+    """
+    Fixed number of equally sized frame slots in one shared memory block.
+    Frames are copied in and out of slots instead of being pickled between processes.
+    """
+
+    def __init__(self, slots_count, slot_size, name=None):
+        """
+        :param slots_count: number of frame slots
+        :param slot_size: max frame size in bytes
+        :param name: name of existing block to attach to, None to create new one
+        """
+        self.slots_count = slots_count
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=slots_count * slot_size)
+
+    def write(self, slot, frame):
+        """
+        Copies frame into slot
+        :return: False if frame does not fit into slot
+        """
+        if frame.nbytes > self.slot_size:
+            return False
+
+        self.read(slot, frame.shape, frame.dtype)[...] = frame
+        return True
+
+    def read(self, slot, shape, dtype):
+        """
+        :return: array view of frame in slot, valid until slot is reused
+        """
+        return np.ndarray(shape, dtype, buffer=self.memory.buf, offset=slot * self.slot_size)
+
+    def close(self, unlink=False):
+        self.memory.close()
+
+        if unlink:
+            self.memory.unlink()
+
+
+def run_effect_worker(function, ring_name, slots_count, slot_size, tasks, results, parent_pid):
+    """
+    Worker process loop: reads frames from ring slots, applies function and writes results back
+    """
+    ring = SharedFrameRing(slots_count, slot_size, ring_name)
+
+    while True:
+        try:
+            task = tasks.get(timeout=1)
+        except queue.Empty:
+            # Parent was terminated without closing pool
+            if os.getppid() != parent_pid:
+                break
+            continue
+
+        if task is None:
+            break
+
+        task_id, slot, shape, dtype, args = task
+        frame = ring.read(slot, shape, dtype).copy()
+
+        try:
+            frame, extra = function(frame, *args)
+        except Exception as error:
+            results.put((task_id, None, None, None, None, error))
+            continue
+
+        frame = np.ascontiguousarray(frame)
+
+        # Results bigger than slot (e.g. upscaled frames) go back pickled
+        if ring.write(slot, frame):
+            results.put((task_id, frame.shape, frame.dtype.str, None, extra, None))
+        else:
+            results.put((task_id, None, None, frame, extra, None))
+
+    ring.close()
+
+
+class EffectWorkerPool:
+    """
+    Process pool applying frame function in parallel.
+    Frames travel through SharedFrameRing, only slot numbers and small arguments are pickled.
+    """
+
+    def __init__(self, function, processes_count, slot_size, slots_count=None):
+        """
+        :param function: top-level function(frame, *args) returning (frame, extra)
+        :param processes_count: number of worker processes
+        :param slot_size: max frame size in bytes
+        :param slots_count: number of frames in flight, twice processes_count by default
+        """
+        context = multiprocessing.get_context("spawn")
+
+        self.function = function
+        self.processes_count = processes_count
+        self.slot_size = slot_size
+        self.slots_count = slots_count or processes_count * 2
+        self.ring = SharedFrameRing(self.slots_count, slot_size)
+        self.free_slots = queue.Queue()
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.waiting = {}
+        self.waiting_lock = threading.Lock()
+        self.task_ids = itertools.count()
+
+        for slot in range(self.slots_count):
+            self.free_slots.put(slot)
+
+        self.processes = [
+            context.Process(
+                target=run_effect_worker,
+                args=(function, self.ring.memory.name, self.slots_count, slot_size,
+                      self.tasks, self.results, os.getpid()),
+                daemon=True,
+            )
+            for i in range(processes_count)
+        ]
+
+        for process in self.processes:
+            process.start()
+
+        self.collector = threading.Thread(target=self._collect_results)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def process(self, frame, *args):
+        """
+        Applies pool function to frame in one of worker processes, thread-safe
+        :return: (frame, extra) returned by function
+        """
+        # Frame is bigger than slots, do it here
+        if frame.nbytes > self.slot_size:
+            return self.function(frame, *args)
+
+        slot = self.free_slots.get()
+        task_id = next(self.task_ids)
+        entry = {"event": threading.Event()}
+
+        try:
+            self.ring.write(slot, frame)
+
+            with self.waiting_lock:
+                self.waiting[task_id] = entry
+
+            self.tasks.put((task_id, slot, frame.shape, frame.dtype.str, args))
+
+            while not entry["event"].wait(1):
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError("Effect worker process died")
+
+            if entry["error"] is not None:
+                raise entry["error"]
+
+            if entry["frame"] is None:
+                entry["frame"] = self.ring.read(slot, entry["shape"], entry["dtype"]).copy()
+        finally:
+            self.free_slots.put(slot)
+
+        return entry["frame"], entry["extra"]
+
+    def close(self):
+        """
+        Stops worker processes and releases shared memory
+        :return:
+        """
+        for process in self.processes:
+            self.tasks.put(None)
+
+        for process in self.processes:
+            process.join()
+
+        self.results.put(None)
+        self.collector.join()
+        self.ring.close(unlink=True)
+
+    def _collect_results(self):
+        while True:
+            result = self.results.get()
+
+            if result is None:
+                break
+
+            task_id, shape, dtype, frame, extra, error = result
+
+            with self.waiting_lock:
+                entry = self.waiting.pop(task_id)
+
+            entry.update({"shape": shape, "dtype": dtype, "frame": frame, "extra": extra, "error": error})
+            entry["event"].set()
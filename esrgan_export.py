@@ -0,0 +1,285 @@
+import os
+import inspect
+import threading
+import numpy as np
+import cv2
+import torch
+
+try:
+    import onnx
+    from onnx import version_converter
+    import onnxruntime
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+except ImportError:
+    onnxruntime = None
+
+
+class OnnxRuntimeNetwork:
+    """
+    ESRGAN exported to ONNX and run by ONNX Runtime on CPU.
+    Called like RRDB_Net with float32 NCHW tensor, returns float32 NCHW tensor.
+    """
+
+    dtype = torch.float32
+
+    def __init__(self, path):
+        """
+        :param path: path to .onnx file
+        """
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, img_LR):
+        output = self.session.run(None, {self.input_name: np.ascontiguousarray(img_LR.cpu().numpy())})[0]
+
+        return torch.from_numpy(output)
+
+
+class CalibrationReader:
+    """
+    Feeds calibration patches to ONNX Runtime static quantization.
+    """
+
+    def __init__(self, input_name, patches):
+        """
+        :param input_name: name of network input
+        :param patches: float32 NCHW RGB arrays in [0, 1]
+        """
+        self.input_name = input_name
+        self.patches = iter(patches)
+
+    def get_next(self):
+        patch = next(self.patches, None)
+
+        return None if patch is None else {self.input_name: patch}
+
+
+class OpenCvDnnNetwork:
+    """
+    ESRGAN exported to ONNX and run by OpenCV DNN, used when ONNX Runtime is not installed.
+    Called like RRDB_Net with float32 NCHW tensor, returns float32 NCHW tensor.
+    """
+
+    dtype = torch.float32
+
+    def __init__(self, path):
+        """
+        :param path: path to .onnx file
+        """
+        self.network = cv2.dnn.readNetFromONNX(path)
+        self.lock = threading.Lock() # cv2.dnn.Net runs one input at a time, tiles can come from several threads
+
+    def __call__(self, img_LR):
+        with self.lock:
+            self.network.setInput(np.ascontiguousarray(img_LR.cpu().numpy()))
+            output = self.network.forward()
+
+        return torch.from_numpy(output)
+
+
+def to_channels_last(value):
+    """
+    :param value: network or NCHW tensor
+    :return: value in NHWC memory format, which convolutions run faster in on GPU,
+    unchanged on torch older than 1.5 which doesn't have it
+    """
+    if not hasattr(torch, "channels_last"):
+        return value
+
+    return value.to(memory_format=torch.channels_last)
+
+
+def resolve_runtime(runtime, device, precision):
+    """
+    :param runtime: "auto", "torch", "torchscript", "onnxruntime", "int8" or "opencv"
+    :param device: device network will run on
+    :param precision: ESRGAN precision, ONNX runtimes run fp32 only
+    :return: runtime to use, "auto" is TorchScript on CUDA or in half precision,
+    ONNX Runtime on CPU if installed and TorchScript otherwise
+    """
+    if runtime != "auto":
+        return runtime
+
+    if device.type == "cuda" or precision not in ("auto", "fp32") or onnxruntime is None:
+        return "torchscript"
+
+    return "onnxruntime"
+
+
+def get_export_path(model_path, runtime):
+    """
+    :return: path of exported network cached next to checkpoint, e.g. falcoon.onnx for falcoon.pth
+    """
+    extension = {"torchscript": ".ts", "int8": ".int8.onnx"}.get(runtime, ".onnx")
+
+    return os.path.splitext(model_path)[0] + extension
+
+
+def is_export_stale(model_path, runtime):
+    """
+    :return: True if network was not exported yet or checkpoint changed since
+    """
+    export_path = get_export_path(model_path, runtime)
+
+    return not os.path.exists(export_path) or os.path.getmtime(export_path) < os.path.getmtime(model_path)
+
+
+def export_network(model, model_path, runtime, calibration_folder="images"):
+    """
+    Traces network once and saves it next to checkpoint
+    :param model: RRDB_Net with loaded weights, float32 on CPU
+    :param model_path: path to .pth checkpoint
+    :param runtime: "torchscript", "int8" or ONNX runtime
+    :param calibration_folder: folder with images for int8 quantization
+    :return: path of exported network
+    """
+    if runtime == "int8":
+        if is_export_stale(model_path, "onnxruntime"):
+            export_network(model, model_path, "onnxruntime")
+
+        return quantize_network(model_path, calibration_folder)
+
+    export_path = get_export_path(model_path, runtime)
+    # Segment worker processes can export same network at once, each renames own file into place
+    temp_path = f"{export_path}.{os.getpid()}.tmp"
+    example = torch.rand(1, 3, 64, 64)
+    # Opset 11 is the newest torch 1.4 can write, newer torch defaults to dynamo exporter
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+    with torch.no_grad():
+        if runtime == "torchscript":
+            torch.jit.trace(model, example).save(temp_path)
+        else:
+            torch.onnx.export(
+                model,
+                (example,),
+                temp_path,
+                input_names=["input"],
+                output_names=["output"],
+                dynamic_axes={
+                    "input": {0: "batch", 2: "height", 3: "width"},
+                    "output": {0: "batch", 2: "height", 3: "width"},
+                },
+                opset_version=11,
+                **options,
+            )
+
+    os.replace(temp_path, export_path)
+
+    return export_path
+
+
+def load_calibration_patches(folder, size=64):
+    """
+    Cuts patches for int8 calibration and quality report from images in folder, same on every run
+    :param folder: folder with images, at least two are needed
+    :param size: patch side, as small as ESRGAN tiles of low-res frames
+    :return: list of patches of each image, patches are float32 NCHW RGB arrays in [0, 1]
+    """
+    image_patches = []
+
+    for name in sorted(os.listdir(folder)):
+        image = cv2.imread(os.path.join(folder, name))
+
+        if image is None or min(image.shape[:2]) < size:
+            continue
+
+        # Frames are upscaled from low resolution, so patches are taken from downscaled image
+        scale = max(size * 4 / min(image.shape[:2]), 0.25)
+        image = cv2.resize(image, None, fx=min(scale, 1), fy=min(scale, 1), interpolation=cv2.INTER_AREA)
+        (h, w) = image.shape[:2]
+        patches = []
+
+        for (y, x) in ((0, 0), ((h - size) // 2, (w - size) // 2), (h - size, w - size)):
+            patch = image[y: y + size, x: x + size, ::-1].transpose(2, 0, 1)
+            patches.append(np.ascontiguousarray(patch[np.newaxis], dtype=np.float32) / 255)
+
+        image_patches.append(patches)
+
+    if len(image_patches) < 2:
+        raise FileNotFoundError(f"Less than two calibration images for int8 ESRGAN in {folder}")
+
+    return image_patches
+
+
+def quantize_network(model_path, calibration_folder):
+    """
+    Quantizes exported ONNX network to static int8 with ONNX Runtime, calibrated on local images
+    Writes quality report with PSNR against float32 network next to it
+    :return: path of quantized network
+    """
+    if onnxruntime is None:
+        raise ImportError("int8 ESRGAN needs onnxruntime")
+
+    source_path = get_export_path(model_path, "onnxruntime")
+    export_path = get_export_path(model_path, "int8")
+    temp_path = f"{export_path}.{os.getpid()}.tmp"
+    upgraded_path = f"{source_path}.{os.getpid()}.tmp"
+    image_patches = load_calibration_patches(calibration_folder)
+    # Every 4th image is held out of calibration, so report shows quality on images quantization didn't see
+    held_out = set(range(3, len(image_patches), 4)) or {len(image_patches) - 1}
+    calibration_patches = [patch for k, patches in enumerate(image_patches) if k not in held_out for patch in patches]
+    report_patches = [patch for k, patches in enumerate(image_patches) if k in held_out for patch in patches]
+
+    # Per-channel QDQ needs opset 13, network is exported in opset 11
+    onnx.save(version_converter.convert_version(onnx.load(source_path), 13), upgraded_path)
+    quantize_static(
+        upgraded_path,
+        temp_path,
+        CalibrationReader("input", calibration_patches[:32]),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+    os.replace(temp_path, export_path)
+    os.remove(upgraded_path)
+
+    report = get_quality_report(source_path, export_path, report_patches)
+    print(report)
+
+    with open(os.path.splitext(export_path)[0] + ".txt", "w") as report_file:
+        report_file.write(report + "\n")
+
+    return export_path
+
+
+def get_quality_report(source_path, quantized_path, patches):
+    """
+    :param patches: patches held out of calibration
+    :return: PSNR of quantized network outputs against float32 network outputs, rounded to 8 bits as in frames
+    """
+    source = OnnxRuntimeNetwork(source_path)
+    quantized = OnnxRuntimeNetwork(quantized_path)
+    psnr_values = []
+
+    for patch in patches:
+        patch = torch.from_numpy(patch)
+        expected = source(patch).clamp(0, 1).mul(255).round()
+        output = quantized(patch).clamp(0, 1).mul(255).round()
+        mse = ((expected - output) ** 2).mean().item()
+        psnr_values.append(100.0 if mse == 0 else 10 * np.log10(255 ** 2 / mse))
+
+    return (f"{os.path.basename(quantized_path)}: PSNR against float32 mean {np.mean(psnr_values):.2f} dB, "
+            f"min {np.min(psnr_values):.2f} dB on {len(patches)} held-out patches")
+
+
+def load_exported_network(model_path, runtime, device, dtype):
+    """
+    :param model_path: path to .pth checkpoint, exported network is loaded from next to it
+    :param runtime: "torchscript", "onnxruntime", "int8" or "opencv"
+    :param device: device for TorchScript network, ONNX runtimes run on CPU
+    :param dtype: dtype for TorchScript network weights
+    :return: network called like RRDB_Net
+    """
+    export_path = get_export_path(model_path, runtime)
+
+    if runtime == "torchscript":
+        network = torch.jit.load(export_path, map_location=device).eval()
+
+        return to_channels_last(network.to(dtype))
+
+    if runtime in ("onnxruntime", "int8"):
+        return OnnxRuntimeNetwork(export_path)
+
+    return OpenCvDnnNetwork(export_path)
@@ -43,6 +43,8 @@ def start_process(auto_start, port, source_type, source, mode, delay=5):
                 mode,
                 "-m",
                 source_type,
+                "-t",
+                str(args["segments"]),
             ],
             bufsize=0,
             stdout=subprocess.PIPE,
@@ -74,6 +76,8 @@ def start_process(auto_start, port, source_type, source, mode, delay=5):
                 mode,
                 "-m",
                 source_type,
+                "-t",
+                str(args["segments"]),
             ],
             bufsize=0
         )
@@ -162,6 +166,13 @@ if __name__ == "__main__":
         required=True,
         help="port number of the server (1024 to 65535)",
     )
+    ap.add_argument(
+        "-t",
+        "--segments",
+        type=int,
+        default=1,
+        help="number of processes rendering uploaded videos in parallel segments",
+    )
 
     args = vars(ap.parse_args())
 
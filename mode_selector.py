@@ -3,17 +3,31 @@ from render_modes import *
 def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
                      f, f1, yolo_network, rcnn_network, caffe_network, superres_network,
                      dain_network, esrgan_network, device, output_layers, classes_index, zip_obj, zip_is_opened,
-                     zipped_images, server_states, started_rendering_video
+                     zipped_images, server_states, started_rendering_video, inference=None
 ):
+    # Network results precomputed by infer_frame_batch for this frame
+    if inference is None:
+        inference = {}
+
+    # Pick denoise filter for source type (temporal for video files, fast for live sources)
+    # and sharpen algorithm selected on page
+    set_denoise_source(server_states.source_mode)
+    set_sharpen_mode(sliders_ajax["sharpenMode"])
+    # Edge maps of previous frame rendered by this thread are dropped
+    reset_edge_maps()
+
     # YOLO Modes
     if modes_ajax["using_yolo_network"]:
         # Find all boxes with classes
-        boxes, indexes, class_ids, confidences, classes_out = find_yolo_classes(
-            main_frame,
-            yolo_network,
-            output_layers,
-            int(sliders_ajax["confidenceSliderValue"])
-        )
+        if "yolo" in inference:
+            boxes, indexes, class_ids, confidences, classes_out = inference["yolo"]
+        else:
+            boxes, indexes, class_ids, confidences, classes_out = find_yolo_classes(
+                main_frame,
+                yolo_network,
+                output_layers,
+                int(sliders_ajax["confidenceSliderValue"])
+            )
         classes_index.append(classes_out)
 
         # Draw boxes with labels on frame
@@ -65,7 +79,10 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
     # MASK R-CNN Modes
     if modes_ajax["using_mask_rcnn_network"]:
         # Find all masks with classes
-        boxes, masks, labels, colors = find_rcnn_classes(main_frame, rcnn_network)
+        if "rcnn" in inference:
+            boxes, masks, labels, colors = inference["rcnn"]
+        else:
+            boxes, masks, labels, colors = find_rcnn_classes(main_frame, rcnn_network)
 
         # Convert background to grayscale and add color objects
         if modes_ajax["color_objects_on_gray"]:
@@ -128,7 +145,8 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
             main_frame = denoise(
                 main_frame,
                 int(sliders_ajax["denoiseSliderValue"]),
-                int(sliders_ajax["denoiseSliderValue2"]))
+                int(sliders_ajax["denoiseSliderValue2"]),
+                "extract_and_replace_background")
 
         # Draw MASK R-CNN objects with canny edge detection on canny blurred background
         if modes_ajax["color_canny"]:
@@ -148,7 +166,8 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
             main_frame = denoise(
                 main_frame,
                 int(sliders_ajax["denoiseSliderValue"]),
-                int(sliders_ajax["denoiseSliderValue2"]))
+                int(sliders_ajax["denoiseSliderValue2"]),
+                "color_canny")
 
         # Draw MASK R-CNN objects with canny edge detection on source background
         if modes_ajax["color_canny_on_background"]:
@@ -163,7 +182,12 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
     # Grayscale frame color restoration with caffe neural network
     if modes_ajax["using_caffe_network"]:
         if modes_ajax["caffe_colorization"]:
-            main_frame = colorizer_caffe(caffe_network, main_frame)
+            if "caffe" in inference:
+                main_frame = inference["caffe"]
+            else:
+                main_frame = colorizer_caffe(
+                    caffe_network, main_frame, int(sliders_ajax["colorIntervalSliderValue"])
+                )
 
     # Cartoon effect (canny, dilate, color quantization with k-means, denoise, sharpen)
     if modes_ajax["cartoon_effect"]:
@@ -206,7 +230,9 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
 
     # Super-resolution upscaler with EDSR, LapSRN and FSRCNN
     if modes_ajax["upscale_opencv"]:
-        main_frame = upscale_with_superres(superres_network, main_frame)
+        main_frame = upscale_with_superres(
+            superres_network, main_frame, int(sliders_ajax["resizeSliderValue"]), "upscale_opencv"
+        )
         main_frame = sharpening(
             main_frame,
             int(sliders_ajax["sharpenSliderValue"]),
@@ -215,7 +241,12 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
 
     # Super-resolution upscaler with ESRGAN (FALCOON, MANGA, PSNR models)
     if modes_ajax["upscale_esrgan"]:
-        main_frame = upscale_with_esrgan(esrgan_network, device, main_frame)
+        if "esrgan" in inference:
+            main_frame = inference["esrgan"]
+        else:
+            main_frame = upscale_with_esrgan(
+                esrgan_network, device, main_frame, int(sliders_ajax["resizeSliderValue"])
+            )
         main_frame = sharpening(
             main_frame,
             int(sliders_ajax["sharpenSliderValue"]),
@@ -242,7 +273,8 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
         main_frame = denoise(
             main_frame,
             int(sliders_ajax["denoiseSliderValue"]),
-            int(sliders_ajax["denoiseSliderValue2"]))
+            int(sliders_ajax["denoiseSliderValue2"]),
+            "denoise_and_sharpen")
 
     # Sobel filter
     if modes_ajax["sobel"]:
@@ -252,7 +284,8 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
             int(sliders_ajax["denoiseSliderValue2"]),
             int(sliders_ajax["sharpenSliderValue"]),
             int(sliders_ajax["sharpenSliderValue2"]),
-            int(sliders_ajax["sobelSliderValue"])
+            int(sliders_ajax["sobelSliderValue"]),
+            sliders_ajax["sobelMode"]
         )
 
     # Boost fps with Depth-Aware Video Frame Interpolation
@@ -264,8 +297,130 @@ def render_with_mode(modes_ajax, sliders_ajax, main_frame, frame_background,
             dain_network, f, f1, 8, True
         )
 
-    # Apply brightness and contrast modes_ajax for all modes
-    main_frame = adjust_br_contrast(main_frame, int(sliders_ajax["contrastSliderValue"]), int(sliders_ajax["brightnessSliderValue"]))
-    main_frame = adjust_saturation(main_frame, int(sliders_ajax["saturationSliderValue"]))
+    # Apply brightness, contrast and saturation for all modes
+    main_frame = adjust_colors(
+        main_frame,
+        int(sliders_ajax["contrastSliderValue"]),
+        int(sliders_ajax["brightnessSliderValue"]),
+        int(sliders_ajax["saturationSliderValue"])
+    )
+
+    return main_frame, frame_boost_sequence, frame_boost_list, classes_index, zipped_images, zip_obj, zip_is_opened
+
+
+def get_batchable_networks(modes_ajax):
+    # Networks that see the decoded frame untouched by earlier stages,
+    # so their results can be computed ahead of time for a batch of frames
+    networks = []
+
+    if modes_ajax["using_yolo_network"]:
+        networks.append("yolo")
+
+    # YOLO modes draw on the frame before Mask R-CNN sees it
+    if modes_ajax["using_mask_rcnn_network"] and not modes_ajax["using_yolo_network"]:
+        networks.append("rcnn")
+
+    if (
+            modes_ajax["caffe_colorization"]
+            and not modes_ajax["using_yolo_network"]
+            and not modes_ajax["using_mask_rcnn_network"]
+    ):
+        networks.append("caffe")
+
+    if (
+            modes_ajax["upscale_esrgan"]
+            and not modes_ajax["using_yolo_network"]
+            and not modes_ajax["using_mask_rcnn_network"]
+            and not modes_ajax["caffe_colorization"]
+            and not modes_ajax["cartoon_effect"]
+            and not modes_ajax["pencil_drawer"]
+            and not modes_ajax["two_colored"]
+            and not modes_ajax["upscale_opencv"]
+    ):
+        networks.append("esrgan")
+
+    return networks
+
+
+def infer_frame_batch(modes_ajax, sliders_ajax, frames, yolo_network, rcnn_network, caffe_network,
+                      esrgan_network, device, output_layers):
+    # Run all batchable networks on a list of frames at once
+    # Returns one inference dictionary per frame for render_with_mode
+    inference = [{} for frame in frames]
+    networks = get_batchable_networks(modes_ajax)
+
+    if len(frames) == 0:
+        return inference
+
+    if "yolo" in networks:
+        results = find_yolo_classes_batch(
+            frames,
+            yolo_network,
+            output_layers,
+            int(sliders_ajax["confidenceSliderValue"])
+        )
+        for frame_inference, result in zip(inference, results):
+            frame_inference["yolo"] = result
+
+    if "rcnn" in networks:
+        results = find_rcnn_classes_batch(frames, rcnn_network)
+        for frame_inference, result in zip(inference, results):
+            frame_inference["rcnn"] = result
+
+    if "caffe" in networks:
+        results = colorizer_caffe_batch(caffe_network, frames, int(sliders_ajax["colorIntervalSliderValue"]))
+        for frame_inference, result in zip(inference, results):
+            frame_inference["caffe"] = result
+
+    if "esrgan" in networks:
+        results = upscale_with_esrgan_batch(
+            esrgan_network, device, frames, int(sliders_ajax["resizeSliderValue"])
+        )
+        for frame_inference, result in zip(inference, results):
+            frame_inference["esrgan"] = result
+
+    return inference
+
+
+class EffectWorkerState:
+    # Stand-in for server states in effect worker processes, they only render video files
+    source_mode = "video"
+
+
+def needs_ordered_frames(modes_ajax, sliders_ajax):
+    # Temporal denoise of video files blends each frame with previous ones of its mode,
+    # so these frames have to be rendered one by one in order, in main process
+    if int(sliders_ajax["denoiseSliderValue2"]) <= 0:
+        return False
+
+    for mode in ("extract_and_replace_background", "color_canny", "cartoon_effect", "pencil_drawer",
+                 "two_colored", "denoise_and_sharpen", "sobel"):
+        if modes_ajax[mode]:
+            return True
+
+    return False
+
+
+def can_render_in_worker_process(modes_ajax, sliders_ajax):
+    # Modes without networks, YOLO zip archive and DAIN frame pairs can run in separate processes
+    # YOLO boxes come precomputed from infer_frame_batch
+    # Color quantizing modes share one k-means palette of main process, so it doesn't flicker between workers
+    for mode in ("using_mask_rcnn_network", "using_caffe_network", "extract_objects_yolo_mode",
+                 "upscale_opencv", "upscale_esrgan", "boost_fps_dain", "cartoon_effect", "pencil_drawer",
+                 "two_colored"):
+        if modes_ajax[mode]:
+            return False
+
+    return not needs_ordered_frames(modes_ajax, sliders_ajax)
+
+
+def render_effects_only(main_frame, modes_ajax, sliders_ajax, inference):
+    # Entry point of effect worker processes, see can_render_in_worker_process
+    classes_index = []
+
+    main_frame, frame_boost_sequence, frame_boost_list, classes_index, zipped_images, zip_obj, zip_is_opened = \
+        render_with_mode(modes_ajax, sliders_ajax, main_frame, None, None, None, None, None, None, None,
+                         None, None, None, None, classes_index, None, False, True,
+                         EffectWorkerState, True, inference)
 
-    return main_frame, frame_boost_sequence, frame_boost_list, classes_index, zipped_images, zip_obj, zip_is_opened
\ No newline at end of file
+    return main_frame, classes_index
@@ -0,0 +1,121 @@
+import queue
+import threading
+from zipfile import ZipFile
+import cv2
+import numpy as np
+
+
+class ObjectArchive:
+    """
+    Zip archive of object crops filled by a background thread.
+    Crops are JPEG-encoded in memory and written with writestr, near-identical crops
+    of the same object in following frames are skipped and archive size is capped.
+    """
+
+    def __init__(self, path, max_objects=5000, max_bytes=200 * 1024 * 1024, duplicate_difference=8,
+                 queue_size=64):
+        """
+        :param path: path to zip file, overwritten
+        :param max_objects: max number of crops in archive
+        :param max_bytes: max size of encoded crops in archive
+        :param duplicate_difference: mean pixel difference of thumbnails below which
+        crop at about the same place is a duplicate
+        :param queue_size: max crops waiting for archiver, more are dropped
+        """
+        self.zip_file = ZipFile(path, "w")
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.duplicate_difference = duplicate_difference
+        self.objects_count = 0
+        self.bytes_count = 0
+        self.closed = False
+        self.crops = queue.Queue(queue_size)
+        self.recent = {} # Last archived (box, thumbnail) pairs for each label
+
+        self.thread = threading.Thread(target=self._archive_crops)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, name, label, box, crop):
+        """
+        Queues crop for archiving, returns at once
+        :param name: file name in archive
+        :param label: object class, duplicates are searched among crops of same class
+        :param box: (x, y, w, h) of crop in frame
+        :param crop: image of object, must not be changed afterwards
+        """
+        if self.closed or crop.size == 0:
+            return
+
+        # Render thread never waits for archiver
+        try:
+            self.crops.put_nowait((name, label, box, crop))
+        except queue.Full:
+            pass
+
+    def close(self):
+        """
+        Archives queued crops and closes zip file, can be called more than once
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.crops.put(None)
+        self.thread.join()
+        self.zip_file.close()
+
+    def _archive_crops(self):
+        while True:
+            item = self.crops.get()
+
+            if item is None:
+                break
+
+            name, label, box, crop = item
+
+            if self.objects_count >= self.max_objects or self.is_duplicate(label, box, crop):
+                continue
+
+            ret, encoded = cv2.imencode(".jpg", crop)
+
+            if not ret or self.bytes_count + len(encoded) > self.max_bytes:
+                continue
+
+            self.zip_file.writestr(name, encoded.tobytes())
+            self.objects_count += 1
+            self.bytes_count += len(encoded)
+
+    def is_duplicate(self, label, box, crop):
+        """
+        Compares crop with last crops of same class overlapping its box, remembers it if it's new
+        :return: True if crop is almost the same as one of them
+        """
+        thumbnail = cv2.resize(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY), (16, 16), interpolation=cv2.INTER_AREA)
+        recent = self.recent.setdefault(label, [])
+
+        for recent_box, recent_thumbnail in recent:
+            if box_overlap(box, recent_box) > 0.5:
+                difference = np.abs(thumbnail.astype(np.int16) - recent_thumbnail).mean()
+
+                if difference < self.duplicate_difference:
+                    return True
+
+        recent.append((box, thumbnail))
+        del recent[:-32]
+
+        return False
+
+
+def box_overlap(box, box2):
+    """
+    :return: intersection over union of two (x, y, w, h) boxes
+    """
+    x, y, w, h = box
+    x2, y2, w2, h2 = box2
+    intersection_w = max(0, min(x + w, x2 + w2) - max(x, x2))
+    intersection_h = max(0, min(y + h, y2 + h2) - max(y, y2))
+    intersection = intersection_w * intersection_h
+    union = w * h + w2 * h2 - intersection
+
+    return intersection / union if union > 0 else 0
@@ -0,0 +1,89 @@
+import os
+import cv2
+
+
+class PreviewSink:
+    """
+    Server-side debug preview of rendered frames, shows nothing.
+    Subclasses send frames to a local window or to image files.
+    """
+
+    def show(self, name, frame):
+        """
+        :param name: preview name, e.g. "video" for rendered frames
+        :param frame: frame to preview
+        :return: False if user asked to stop rendering
+        """
+        return True
+
+    def close(self):
+        pass
+
+
+class WindowPreviewSink(PreviewSink):
+    """
+    Shows previews in local OpenCV windows, "q" key stops rendering.
+    """
+
+    def show(self, name, frame):
+        cv2.imshow(name, frame)
+        key = cv2.waitKey(1) & 0xFF
+
+        return key != ord("q")
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+
+class FilePreviewSink(PreviewSink):
+    """
+    Dumps every n-th preview of each name as JPEG into folder.
+    """
+
+    def __init__(self, folder, every=25):
+        """
+        :param folder: folder for image files, created if missing
+        :param every: save one of this many frames of each preview name
+        """
+        os.makedirs(folder, exist_ok=True)
+
+        self.folder = folder
+        self.every = every
+        self.counters = {}
+
+    def show(self, name, frame):
+        counter = self.counters.get(name, 0)
+        self.counters[name] = counter + 1
+
+        if counter % self.every == 0:
+            cv2.imwrite(os.path.join(self.folder, f"{name}_{counter:06d}.jpg"), frame)
+
+        return True
+
+
+preview_sink = PreviewSink()
+
+
+def set_preview_sink(preview):
+    """
+    Selects sink for all previews of this process
+    :param preview: "none", "window" or folder to dump preview images to
+    """
+    global preview_sink
+
+    preview_sink.close()
+
+    if preview == "none":
+        preview_sink = PreviewSink()
+    elif preview == "window":
+        preview_sink = WindowPreviewSink()
+    else:
+        preview_sink = FilePreviewSink(preview)
+
+
+def show_preview(name, frame):
+    """
+    Sends frame to selected preview sink, does nothing by default
+    :return: False if user asked to stop rendering
+    """
+    return preview_sink.show(name, frame)
@@ -13,7 +13,12 @@ from flask import request, Response
 import psutil
 from mode_selector import *
 from werkzeug.utils import secure_filename
-from zipfile import ZipFile
+from render_pipeline import FramePipeline
+from effect_workers import EffectWorkerPool
+from segment_render import SegmentRenderer
+from preview_sink import set_preview_sink, show_preview
+from object_archive import ObjectArchive
+from device_select import get_network_devices, set_dnn_backend, dnn_backends
 import pafy
 
 app = Flask(__name__, static_url_path="/static")
@@ -45,6 +50,8 @@ class State:
     render_mode = ""
     superres_model = "LAPSRN"
     esrgan_model = "FALCOON"
+    esrgan_alpha = 0.8 # ESRGAN weight in PSNR / ESRGAN interpolation
+    render_error = "" # Last rendering failure, shown on page in stats
 
 
 # Rendering modes dictionary
@@ -99,11 +106,15 @@ settings_ajax = {
     "asciiSizeSliderValue" : 4,
     "asciiIntervalSliderValue" : 10,
     "asciiThicknessSliderValue" : 1,
-    "resizeSliderValue" : 2,
+    "resizeSliderValue" : 2160,
     "colorCountSliderValue" : 32,
+    "esrganAlphaSliderValue" : 80,
+    "colorIntervalSliderValue" : 1,
     "mode" : "a",
-    "superresModel" : "LapSRN",
+    "superresModel" : "LAPSRN",
     "esrganModel" : "FALCOON",
+    "sharpenMode" : "DETAIL",
+    "sobelMode" : "SOBEL",
     "urlSource": "default"
 }
 
@@ -148,6 +159,74 @@ def check_if_user_is_connected(timer_start, seconds_to_disconnect):
             p.terminate()  # or p.kill()
 
 
+def get_inference_batch_size(frame_width, frame_height, max_batch_size=8):
+    """
+    Chooses how many frames to push through neural networks at once
+    :param frame_width: source frame width
+    :param frame_height: source frame height
+    :param max_batch_size: upper limit of frames in one batch
+    :return: batch size fitting into a quarter of available RAM
+    """
+    # Rough per-frame footprint of float32 network inputs and activations
+    frame_bytes = frame_width * frame_height * 3 * 4 * 16
+
+    # ESRGAN keeps x16 pixels of float output per frame on top of that
+    if render_modes_dict['upscale_esrgan']:
+        frame_bytes *= 4
+
+    if frame_bytes <= 0:
+        return 1
+
+    batch_size = int(psutil.virtual_memory().available / 4 // frame_bytes)
+
+    return max(1, min(batch_size, max_batch_size))
+
+
+def get_render_workers_count():
+    """
+    Chooses number of effect threads for render pipeline
+    :return: 1 for neural network modes and temporal denoise, otherwise most of CPU cores
+    """
+    # Networks, YOLO zip archive and DAIN frame pairs are not thread-safe
+    for mode in ('using_yolo_network', 'using_mask_rcnn_network', 'using_caffe_network',
+                 'upscale_opencv', 'upscale_esrgan', 'boost_fps_dain'):
+        if render_modes_dict[mode]:
+            return 1
+
+    if needs_ordered_frames(render_modes_dict, settings_ajax):
+        return 1
+
+    return max(1, (os.cpu_count() or 1) - 2)
+
+
+def get_effect_processes_count():
+    """
+    Chooses number of effect worker processes
+    :return: CPU cores left after decoding, inference, encoding and web server threads
+    """
+    return max(1, (os.cpu_count() or 1) - 2)
+
+
+def read_frame_batch(cap, batch_size):
+    """
+    Reads up to batch_size next frames from capture
+    :param cap: VideoCapture object
+    :param batch_size: number of frames to read
+    :return: list of frames, shorter than batch_size at the end of video
+    """
+    frames = []
+
+    while len(frames) < batch_size:
+        ret, frame = cap.read()
+
+        if frame is None:
+            break
+
+        frames.append(frame)
+
+    return frames
+
+
 def process_frame():
     """
     Main rendering function
@@ -176,6 +255,15 @@ def process_frame():
     resized = None # Resized frame to put on page
     fps = 0 # FPS rate
     frameEdge = None # Last frame of interpolation sequence
+    pipeline = None # Staged render pipeline for video file rendering
+    last_frame_source = None # Position and source of last frame, colorization and palette history reset on change
+    pipeline_ordered = False # Pipeline renders effects of frames one by one in order
+    effect_pool = None # Worker processes for effects stage of pipeline
+    segment_renderer = None # Worker processes rendering video file in parallel segments
+    segments_failed = False # Segment rendering failed, video is rendered serially until next start
+    rendered_batch = [] # Frames from pipeline waiting for preview and stats
+    last_batch_moment = 0 # Timer for FPS calculation of pipeline batches
+    batch_frame_time = 0 # Average time of one frame in last pipeline batch
 
     path_to_file, file_to_render = os.path.split(args["source"]) # Get filename from full path
     print ("Processing file: " + file_to_render)
@@ -208,32 +296,98 @@ def process_frame():
         server_states.source_image = image_file
 
     cap2 = cv2.VideoCapture("input_videos/space.webm") # Secondary video for background replacement
-    zip_obj = ZipFile(f"static/user_renders/output{args['port']}.zip", "w") # Zip file with user port name
+    zip_obj = ObjectArchive(f"static/user_renders/output{args['port']}.zip") # Zip file with user port name
 
     # Initialize all models
     caffe_network = initialize_caffe_network()
-    caffe_network.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-    caffe_network.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
     superres_network = initialize_superres_network("LAPSRN")
-    esrgan_network, device = initialize_esrgan_network("FALCOON", True)
-    rcnn_network = initialize_rcnn_network(True)
-    dain_network = initialize_dain_network(True)
-    yolo_network, layers_names, output_layers, colors_yolo = initialize_yolo_network(
-        classes, True
-    )
+    esrgan_network, device = initialize_esrgan_network("FALCOON")
+    rcnn_network = initialize_rcnn_network()
+    dain_network = initialize_dain_network()
+    yolo_network, layers_names, output_layers, colors_yolo = initialize_yolo_network(classes)
 
     frame_interp_num = 0 # Interpolated frame number
     main_frame = None
     f = f1 = None # Two source frames for interpolation
 
+    # =============================== Render pipeline stages ===============================
+
+    def read_pipeline_batch():
+        # Decode stage: read next frames of video file with background frames
+        batch_size = 1
+
+        if len(get_batchable_networks(render_modes_dict)) > 0:
+            batch_size = get_inference_batch_size(
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            )
+
+        frames = read_frame_batch(cap, batch_size)
+
+        if len(frames) == 0:
+            return None
+
+        backgrounds = [cap2.read()[1] for frame in frames]
+
+        return {"frames": frames, "backgrounds": backgrounds}
+
+    def infer_pipeline_batch(batch):
+        # Inference stage: run batchable networks on all frames at once
+        batch["inference"] = infer_frame_batch(
+            render_modes_dict, settings_ajax, batch["frames"], yolo_network, rcnn_network,
+            caffe_network, esrgan_network, device, output_layers
+        )
+
+        return batch
+
+    def render_pipeline_batch(batch):
+        # Effects stage: draw frames with render modes and settings
+        global zip_obj
+        nonlocal zipped_images, zip_is_opened
+
+        batch["classes_index"] = []
+
+        for k in range(len(batch["frames"])):
+            frame_classes_index = []
+
+            if not server_states.view_source:
+                if effect_pool is not None and can_render_in_worker_process(render_modes_dict, settings_ajax):
+                    batch["frames"][k], frame_classes_index = effect_pool.process(
+                        batch["frames"][k], dict(render_modes_dict), dict(settings_ajax), batch["inference"][k]
+                    )
+                else:
+                    batch["frames"][k], frame_boost_sequence, frame_boost_list, frame_classes_index, zipped_images, \
+                        zip_obj, zip_is_opened = render_with_mode(
+                            render_modes_dict, settings_ajax, batch["frames"][k], batch["backgrounds"][k], None, None,
+                            yolo_network, rcnn_network, caffe_network, superres_network, dain_network, esrgan_network,
+                            device, output_layers, frame_classes_index, zip_obj, zip_is_opened, zipped_images,
+                            server_states, True, batch["inference"][k])
+
+            batch["classes_index"].append(frame_classes_index)
+
+        return batch
+
+    def encode_pipeline_batch(batch):
+        # Encode stage: write frames to video file in source order
+        for frame in batch["frames"]:
+            writer.write(frame)
+
+        return batch
+
     # =============================== Main processing loop ===============================
 
     while server_states.working_on:
+        classes_index = [] # YOLO classes found in current frame
+        frame_rendered = False # Frame was already rendered by pipeline
+        frame_time = None # Frame time measured by pipeline
+        segment_frames_done = None # Frames rendered by segment workers
+
         # Receive all HTML slider values from JSON dictionary
         if settings_ajax is not None:
             mode_from_page = str(settings_ajax["mode"])
             superres_model_from_page = str(settings_ajax["superresModel"])
             esrgan_model_from_page = str(settings_ajax["esrganModel"])
+            esrgan_alpha_from_page = int(settings_ajax["esrganAlphaSliderValue"]) / 100
             position_value_local = int(settings_ajax["positionSliderValue"])
             server_states.view_source = bool(settings_ajax["viewSource"])
 
@@ -245,12 +399,23 @@ def process_frame():
                 server_states.mode_reset_lock = False
                 need_mode_reset = True
 
+            # Interpolated ESRGAN is blended in memory, so slider changes it without mode reset
+            if esrgan_alpha_from_page != server_states.esrgan_alpha:
+                server_states.esrgan_alpha = esrgan_alpha_from_page
+
+                if server_states.esrgan_model == "RRDB_INTERP" and not need_mode_reset:
+                    esrgan_network, device = initialize_esrgan_network(
+                        server_states.esrgan_model, server_states.esrgan_alpha
+                    )
+
             # Check if video rendering start command was received
             if server_states.video_reset_lock:
                 position_value = 1 # Reset position
                 need_to_create_writer = True # Create new writer
                 started_rendering_video = True
                 received_zip_command = True
+                segments_failed = False
+                server_states.render_error = ""
                 server_states.video_reset_lock = False
                 # print("in loop reset")
             else:
@@ -271,9 +436,25 @@ def process_frame():
         else:
             position_value = 1
 
+        if (position_value, cap, server_states.source_mode, server_states.source_image) != last_frame_source:
+            reset_caffe_history()
+            reset_palette_cache()
+            last_frame_source = (position_value, cap, server_states.source_mode, server_states.source_image)
+
         # If user changed rendering mode
         if need_mode_reset:
             frame_interp_num = 0
+            reset_caffe_history()
+            reset_palette_cache()
+
+            if pipeline is not None:
+                pipeline.stop()
+                pipeline = None
+                rendered_batch = []
+
+            if segment_renderer is not None:
+                segment_renderer.stop()
+                segment_renderer = None
             # Reset all modes
             for mode in render_modes_dict:
                 render_modes_dict[mode] = False
@@ -281,7 +462,9 @@ def process_frame():
 
             # Reinitialize upscale networks with user models from page
             superres_network = initialize_superres_network(server_states.superres_model)
-            esrgan_network, device = initialize_esrgan_network(server_states.esrgan_model, True)
+            esrgan_network, device = initialize_esrgan_network(
+                server_states.esrgan_model, server_states.esrgan_alpha
+            )
 
             # Set processing algorithm from HTML page
             for mode in server_states.render_mode:
@@ -358,8 +541,12 @@ def process_frame():
                     render_modes_dict['upscale_esrgan'] = True
                     print("upscale_esrgan")
                 if mode == "z":
-                    render_modes_dict['boost_fps_dain'] = True
-                    print("boost_fps_dain")
+                    # DAIN network is None on nodes without CUDA
+                    if dain_network is None:
+                        print("boost_fps_dain needs CUDA, mode is unavailable")
+                    else:
+                        render_modes_dict['boost_fps_dain'] = True
+                        print("boost_fps_dain")
 
                 need_mode_reset = False
         
@@ -368,6 +555,16 @@ def process_frame():
             # If stopped rendering
             if not started_rendering_video:
                 # print("in stop loop")
+                # Pipeline decode thread reads same capture, so it's stopped before seeking
+                if pipeline is not None:
+                    pipeline.stop()
+                    pipeline = None
+                    rendered_batch = []
+
+                if segment_renderer is not None:
+                    segment_renderer.stop()
+                    segment_renderer = None
+
                 if (cap is not None):
                     cap.set(1, position_value) # Set current video position from HTML slider value
                     server_states.frame_processed = 0
@@ -382,6 +579,16 @@ def process_frame():
                 if need_to_create_writer or file_changed:
                     # cap.set(1, 1)
                     server_states.frame_processed = 0
+
+                    # Pipeline may still be writing to old writer
+                    if pipeline is not None:
+                        pipeline.stop()
+                        pipeline = None
+                        rendered_batch = []
+
+                    if segment_renderer is not None:
+                        segment_renderer.stop()
+                        segment_renderer = None
                     # cap.release()
                     if writer is not None:
                         writer.release()
@@ -450,18 +657,79 @@ def process_frame():
 
                     # Prepare zip opening for YOLO objects
                     if need_to_create_new_zip:
-                        zip_obj = ZipFile(f"static/user_renders/output{args['port']}.zip", "w")
+                        zip_obj.close()
+                        zip_obj = ObjectArchive(f"static/user_renders/output{args['port']}.zip")
                         need_to_stop_new_zip = True
                         need_to_create_new_zip = False
                         zip_is_opened = True
                     if file_changed:
-                        zip_obj = ZipFile(f"static/user_renders/output{args['port']}.zip", "w")
+                        zip_obj.close()
+                        zip_obj = ObjectArchive(f"static/user_renders/output{args['port']}.zip")
                         zip_is_opened = True
                     file_changed = False
                     need_to_create_writer = False
 
+            # Render whole video file in parallel segments, each in own process
+            if (
+                    server_states.source_mode == "video"
+                    and started_rendering_video
+                    and args["segments"] > 1
+                    and not render_modes_dict['extract_objects_yolo_mode']
+                    and not segments_failed
+            ):
+                try:
+                    if segment_renderer is None:
+                        # Output file is joined from segments, not written frame by frame
+                        writer.release()
+                        segment_renderer = SegmentRenderer(
+                            f"{app.config['UPLOAD_FOLDER']}{file_to_render}",
+                            f"static/user_renders/output{args['port']}{file_to_render}.avi",
+                            server_states.total_frames,
+                            args["segments"],
+                            dict(render_modes_dict),
+                            dict(settings_ajax),
+                            server_states.superres_model,
+                            server_states.esrgan_model,
+                            60 if render_modes_dict['boost_fps_dain'] else 25,
+                            int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) * int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) * 3,
+                            (args["tile_size"], args["tile_overlap"], args["tile_workers"], args["esrgan_precision"],
+                             args["esrgan_runtime"], args["esrgan_calibration"]),
+                            args["dnn_backend"],
+                        )
+
+                    segments_finished = segment_renderer.is_finished()
+                except Exception as error:
+                    # Failed segment or join falls back to serial rendering from first frame into new writer
+                    print(f"Segment rendering failed, rendering serially: {error}")
+                    server_states.render_error = f"Segment rendering failed, rendered serially: {error}"
+
+                    if segment_renderer is not None:
+                        segment_renderer.stop()
+                        segment_renderer = None
+
+                    segments_failed = True
+                    need_to_create_writer = True
+                    cap.set(1, 0)
+                    segments_finished = False
+
+                if segments_failed:
+                    # Last shown frame stays on page until serial rendering starts next iteration
+                    frame_rendered = True
+                    segment_frames_done = 0
+                elif segments_finished:
+                    segment_renderer = None
+                    main_frame = None
+                else:
+                    time.sleep(0.1)
+                    segment_frames_done = segment_renderer.frames_done()
+                    frame_rendered = True
+                    preview_frame = segment_renderer.preview()
+
+                    # Keep last shown frame until workers render something
+                    if preview_frame is not None:
+                        main_frame = preview_frame
             # Fill f and f1 pair of frames for DAIN interpolation
-            if (render_modes_dict['boost_fps_dain']):
+            elif (render_modes_dict['boost_fps_dain']):
                 if (started_rendering_video):
                     if (frame_interp_num == 0):
                         cap.set(1, 0)
@@ -481,6 +749,64 @@ def process_frame():
                 else:
                     ret, main_frame = cap.read()
                     ret2, frame_background = cap2.read()
+            # Render video file with staged pipeline: decode -> inference -> effects -> encode
+            elif server_states.source_mode == "video" and started_rendering_video:
+                # Temporal denoise enabled with slider during rendering needs pipeline with one effect worker
+                if pipeline is not None and not pipeline_ordered and \
+                        needs_ordered_frames(render_modes_dict, settings_ajax):
+                    pipeline.stop()
+                    pipeline = None
+                    rendered_batch = []
+
+                if pipeline is None:
+                    render_workers_count = get_render_workers_count()
+                    pipeline_ordered = render_workers_count == 1
+
+                    # Run effects in worker processes with frames in shared memory
+                    if can_render_in_worker_process(render_modes_dict, settings_ajax):
+                        frame_size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) * int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) * 3
+
+                        if effect_pool is not None and effect_pool.slot_size < frame_size:
+                            effect_pool.close()
+                            effect_pool = None
+
+                        if effect_pool is None:
+                            effect_pool = EffectWorkerPool(render_effects_only, get_effect_processes_count(), frame_size)
+
+                        render_workers_count = effect_pool.processes_count
+
+                    pipeline = FramePipeline(
+                        read_pipeline_batch,
+                        [
+                            (infer_pipeline_batch, 1),
+                            (render_pipeline_batch, render_workers_count),
+                            (encode_pipeline_batch, 1),
+                        ]
+                    )
+                    last_batch_moment = time.time()
+
+                if len(rendered_batch) == 0:
+                    try:
+                        batch = pipeline.get()
+                    except Exception as error:
+                        # Failed stage stops pipeline, rendering stops with error in stats instead of render thread
+                        print(f"Render pipeline failed: {error}")
+                        server_states.render_error = f"Render pipeline failed: {error}"
+                        pipeline.stop()
+                        pipeline = None
+                        batch = None
+
+                    if batch is not None:
+                        rendered_batch = list(zip(batch["frames"], batch["classes_index"]))
+                        batch_frame_time = (time.time() - last_batch_moment) / len(rendered_batch)
+                        last_batch_moment = time.time()
+
+                if len(rendered_batch) > 0:
+                    main_frame, classes_index = rendered_batch.pop(0)
+                    frame_rendered = True
+                    frame_time = batch_frame_time
+                else:
+                    main_frame = None
             # ... otherwise read by one frame
             else:
                 if (cap is not None):
@@ -492,13 +818,15 @@ def process_frame():
             # Prepare zip opening for YOLO objects
             if received_zip_command or file_changed:
                 zipped_images = False
-                zip_obj = ZipFile(f"static/user_renders/output{args['port']}.zip", "w")
+                zip_obj.close()
+                zip_obj = ObjectArchive(f"static/user_renders/output{args['port']}.zip")
                 zip_is_opened = True
                 received_zip_command = False
                 # print("CREATED ZIP =========================")
 
             if file_changed:
-                zip_obj = ZipFile(f"static/user_renders/output{args['port']}.zip", "w")
+                zip_obj.close()
+                zip_obj = ObjectArchive(f"static/user_renders/output{args['port']}.zip")
                 zip_is_opened = True
                 file_changed = False
                 need_to_create_writer = False
@@ -506,13 +834,15 @@ def process_frame():
             main_frame = cv2.imread(f"{app.config['UPLOAD_FOLDER']}{server_states.source_image}")
             ret2, frame_background = cap2.read()
 
-        classes_index = []
         start_moment = time.time()  # Timer for FPS calculation
-        
+
+        if frame_time is not None:
+            start_moment -= frame_time
+
         # =============================== Draw frame with render modes and settings ===============================
 
         if main_frame is not None:
-            if not server_states.view_source:
+            if not server_states.view_source and not frame_rendered:
                 main_frame, frame_boost_sequence, frame_boost_list, classes_index, zipped_images, zip_obj, zip_is_opened = \
                     render_with_mode(render_modes_dict, settings_ajax, main_frame, frame_background, f, f1, yolo_network,
                                      rcnn_network, caffe_network, superres_network, dain_network, esrgan_network,
@@ -521,7 +851,10 @@ def process_frame():
 
             with lock:
                 check_if_user_is_connected(timer_start, 7) # Terminate process if browser tab was closed
-                server_states.frame_processed += 1
+                if segment_frames_done is not None:
+                    server_states.frame_processed = segment_frames_done
+                else:
+                    server_states.frame_processed += 1
 
                 elapsed_time = time.time()
                 fps = 1 / (elapsed_time - start_moment)
@@ -558,6 +891,7 @@ def process_frame():
                         server_states.source_mode in ("video", "youtube", "ipcam")
                         and writer is not None
                         and started_rendering_video
+                        and not frame_rendered
                 ):
                     if render_modes_dict['boost_fps_dain'] and started_rendering_video:
                         frame_boost_sequence, frame_boost_list = zip(
@@ -566,20 +900,12 @@ def process_frame():
 
                         for i in range (len(frame_boost_list) - 1):
                             writer.write(frame_boost_list[i])
-                            # cv2.imshow("video", frame)
-                            key = cv2.waitKey(1) & 0xFF
-
-                            if key == ord("q"):
-                                break
 
                     else:
                         writer.write(main_frame)
 
-                # Preview rendering on server
-                cv2.imshow("video", main_frame)
-                key = cv2.waitKey(1) & 0xFF
-
-                if key == ord("q"):
+                # Preview rendering on server, off unless enabled with --preview
+                if not show_preview("video", main_frame):
                     break
 
                 # Calculate progress
@@ -800,7 +1126,9 @@ def send_stats():
             "currentMode": server_states.render_mode,
             "userTime": user_time,
             "screenshotReady": screenshot_ready_local,
-            "screenshotPath": server_states.screenshot_path
+            "screenshotPath": server_states.screenshot_path,
+            "networkDevices": get_network_devices(),
+            "renderError": server_states.render_error,
             # 'time': datetime.datetime.now().strftime("%H:%M:%S"),
         }
     )
@@ -858,8 +1186,80 @@ if __name__ == "__main__":
         required=True,
         help="rendering mode: 'video' or 'image'",
     )
+    ap.add_argument(
+        "-t",
+        "--segments",
+        type=int,
+        default=1,
+        help="number of processes rendering video file in parallel segments (1 to render sequentially)",
+    )
+    ap.add_argument(
+        "-p",
+        "--preview",
+        type=str,
+        default="none",
+        help="server-side debug preview: 'none', 'window' or folder to dump preview images to",
+    )
+
+    ap.add_argument(
+        "--tile_size",
+        type=int,
+        default=256,
+        help="ESRGAN upscales bigger frames in tiles of this size (0 to upscale whole frames)",
+    )
+    ap.add_argument(
+        "--tile_overlap",
+        type=int,
+        default=16,
+        help="overlap of ESRGAN tiles in pixels, blended to hide seams",
+    )
+    ap.add_argument(
+        "--tile_workers",
+        type=int,
+        default=1,
+        help="number of ESRGAN tiles upscaled in parallel on CPU",
+    )
+    ap.add_argument(
+        "--esrgan_precision",
+        type=str,
+        default="auto",
+        choices=["auto", "fp32", "fp16", "bf16"],
+        help="ESRGAN weights and activations precision ('auto' is fp16 on CUDA and fp32 on CPU)",
+    )
+    ap.add_argument(
+        "--esrgan_runtime",
+        type=str,
+        default="auto",
+        choices=["auto", "torch", "torchscript", "onnxruntime", "int8", "opencv"],
+        help="ESRGAN runtime, exported networks are cached next to .pth files "
+             "('auto' is ONNX Runtime on CPU if installed, TorchScript otherwise)",
+    )
+    ap.add_argument(
+        "--esrgan_calibration",
+        type=str,
+        default="images",
+        help="folder with images to calibrate int8 ESRGAN on",
+    )
+    ap.add_argument(
+        "--dnn_backend",
+        type=str,
+        default="auto",
+        choices=["auto"] + list(dnn_backends),
+        help="backend for OpenCV networks, falls back to plain CPU if not available "
+             "('auto' tries CUDA, OpenVINO, OpenCL and CPU)",
+    )
 
     args = vars(ap.parse_args())
+    set_preview_sink(args["preview"])
+    set_dnn_backend(args["dnn_backend"])
+    set_esrgan_options(
+        args["tile_size"],
+        args["tile_overlap"],
+        args["tile_workers"],
+        args["esrgan_precision"],
+        args["esrgan_runtime"],
+        args["esrgan_calibration"],
+    )
 
     t = threading.Thread(target=process_frame)
     t.daemon = True
@@ -1,6 +1,5 @@
 import numpy as np
 import numpy
-from random import randint
 from sklearn.cluster import MiniBatchKMeans
 import ESRGAN.architecture as arch
 import time
@@ -9,7 +8,13 @@ from torch.autograd import Variable
 import torch
 import cv2
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 import DAIN.networks
+from preview_sink import show_preview
+from device_select import select_dnn_backend, select_torch_device, record_network_device, get_blank_blob
+from esrgan_export import resolve_runtime, is_export_stale, export_network, load_exported_network, to_channels_last
 
 classes = []
 
@@ -18,14 +23,47 @@ with open("models/yolo/coco.names", "r") as f:
 
 colors_yolo = np.random.uniform(0, 255, size=(len(classes), 3))
 object_index = 0
-
-
-def initialize_yolo_network(classes, use_cuda):
+glyph_atlas_cache = {}
+palette_cache = {} # Palette of limit_colors_kmeans for each color count, refit when scene colors drift
+palette_lock = threading.Lock()
+sharpening_kernels = {}
+sharpen_mode = "DETAIL" # Set from page with set_sharpen_mode
+denoise_mode = "single" # Set from source type with set_denoise_source
+denoise_history = {} # Previous denoised frames for temporal denoise
+denoise_lock = threading.Lock()
+esrgan_tile_size = 256 # Bigger frames are upscaled by ESRGAN in tiles, set with set_esrgan_options
+esrgan_tile_overlap = 16
+esrgan_tile_workers = 1
+esrgan_precision = "auto"
+esrgan_runtime = "auto" # Exported ESRGAN networks are cached next to checkpoints, see esrgan_export
+esrgan_calibration_folder = "images" # Images for int8 ESRGAN calibration
+esrgan_interp_weights = {} # PSNR and ESRGAN state dicts, loaded once for interpolation
+esrgan_interp_networks = OrderedDict() # Recently blended networks by (alpha, device, dtype)
+esrgan_interp_cache_size = 4
+caffe_history = {} # Last network chroma of each colorization mode, see colorizer_caffe
+caffe_lock = threading.Lock()
+upscale_history = {} # Last source and upscaled frames of each upscaler, see upscale_changed_blocks
+upscale_lock = threading.Lock()
+upscale_block_size = 64 # Blocks of source frame compared by upscaler change detection
+upscale_change_threshold = 8 # Block changed if mean difference of any 4x4 pixels in it is bigger
+superres_models = { # OpenCV superres algorithm and file prefix in models/upscalers for each page model
+    "EDSR": ("edsr", "EDSR"),
+    "LAPSRN": ("lapsrn", "LapSRN"),
+    "FSRCNN": ("fsrcnn", "FSRCNN"),
+    "FSRCNN_SMALL": ("fsrcnn", "FSRCNN-small"),
+}
+superres_margins = { # Source pixels around a block that reach its output through convolutions of each algorithm
+    "edsr": 40, # 34 3x3 convolutions at source resolution, rest at upscaled one
+    "lapsrn": 20, # 11 convolutions at source resolution and 10 at twice it
+    "fsrcnn": 8, # 5x5 and four 3x3 convolutions, then deconvolution at upscaled resolution
+}
+edge_maps = threading.local() # Edge maps of frame rendered by this thread, see get_edge_map
+palette_drift_threshold = 1.3 # Refit palette when colors are this much farther from it than at fit
+
+
+def initialize_yolo_network(classes):
     yolo_network = cv2.dnn.readNet("models/yolo/yolov3.weights", "models/yolo/yolov3.cfg")
-
-    if use_cuda:
-        yolo_network.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-        yolo_network.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+    select_dnn_backend(yolo_network, "yolo", get_blank_blob(608, 608))
 
     layers_names = yolo_network.getLayerNames()
     output_layers = [layers_names[i[0] - 1] for i in yolo_network.getUnconnectedOutLayers()]
@@ -118,14 +156,11 @@ def draw_yolo_stats(input_frame, classes_index, font):
     return input_frame
 
 
-def initialize_rcnn_network(use_cuda):
+def initialize_rcnn_network():
     weights_path = "models/mask-rcnn/frozen_inference_graph.pb"
     config_path = "models/mask-rcnn/mask_rcnn_inception_v2_coco_2018_01_28.pbtxt"
     rcnn_network = cv2.dnn.readNetFromTensorflow(weights_path, config_path)
-
-    if use_cuda:
-        rcnn_network.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-        rcnn_network.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+    select_dnn_backend(rcnn_network, "rcnn", get_blank_blob(300, 300))
 
     return rcnn_network
 
@@ -141,28 +176,34 @@ def initialize_caffe_network():
     pts = pts.transpose().reshape(2, 313, 1, 1)
     net.getLayer(class8).blobs = [pts.astype("float32")]
     net.getLayer(conv8).blobs = [np.full([1, 313], 2.606, dtype="float32")]
+    select_dnn_backend(net, "caffe", get_blank_blob(224, 224, 1))
     return net
 
 
 def initialize_superres_network(model_type):
-    sr = cv2.dnn_superres.DnnSuperResImpl_create()
-
-    if (model_type == "EDSR"):
-        sr.readModel("models/upscalers/EDSR_x4.pb")
-        sr.setModel("edsr", 4)
-    if (model_type == "LAPSRN"):
-        sr.readModel("models/upscalers/LapSRN_x4.pb")
-        sr.setModel("lapsrn", 4)
-    if (model_type == "FSRCNN"):
-        sr.readModel("models/upscalers/FSRCNN_x4.pb")
-        sr.setModel("fsrcnn", 4)
-    if (model_type == "FSRCNN_SMALL"):
-        sr.readModel("models/upscalers/FSRCNN-small_x4.pb")
-        sr.setModel("fsrcnn", 4)
-    return sr
-
-
-def initialize_esrgan_network(model_type, use_cuda):
+    # Returns networks by scale: x4 and x2, x3 ones found in models/upscalers,
+    # upscale_with_superres picks smallest one reaching target resolution
+    # Model name comes from page, unknown ones fall back to LapSRN
+    if model_type not in superres_models:
+        print(f"Unknown superres model {model_type}, using LAPSRN")
+        model_type = "LAPSRN"
+
+    algorithm, file_prefix = superres_models[model_type]
+    networks = {}
+
+    for scale in (2, 3, 4):
+        model_path = f"models/upscalers/{file_prefix}_x{scale}.pb"
+
+        if scale == 4 or os.path.exists(model_path):
+            sr = cv2.dnn_superres.DnnSuperResImpl_create()
+            sr.readModel(model_path)
+            sr.setModel(algorithm, scale)
+            networks[scale] = select_dnn_backend(sr, f"superres_x{scale}", np.zeros((128, 128, 3), np.uint8))
+
+    return networks
+
+
+def initialize_esrgan_network(model_type, alpha=0.8):
     model_path = ""
     device = torch.device("cpu")
 
@@ -178,26 +219,76 @@ def initialize_esrgan_network(model_type, use_cuda):
     if (model_type == "RRDB_PSNR"):
         model_path = "models/esrgan/RRDB_PSNR_x4_old_arch.pth"
 
-    if (model_type == "RRDB_INTERP_0.2"):
-        model_path = "models/esrgan/interp_02.pth"
+    device = select_torch_device("esrgan")
 
-    if (model_type == "RRDB_INTERP_0.4"):
-        model_path = "models/esrgan/interp_04.pth"
+    # Half precision and NHWC layout run faster where convolutions support them
+    precision = esrgan_precision
 
-    if (model_type == "RRDB_INTERP_0.6"):
-        model_path = "models/esrgan/interp_06.pth"
+    if precision == "auto":
+        precision = "fp16" if device.type == "cuda" else "fp32"
 
-    if (model_type == "RRDB_INTERP_0.8"):
-        model_path = "models/esrgan/interp_08.pth"
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(precision, torch.float32)
 
-    if use_cuda:
-        device = torch.device("cuda")
-    else:
+    # PSNR and ESRGAN weights are blended in memory for any alpha, blended networks run eager
+    if model_type == "RRDB_INTERP":
+        record_network_device("esrgan", f"{device.type.upper()} torch {precision}")
+        return get_interpolated_esrgan_network(alpha, device, dtype), device
+
+    runtime = resolve_runtime(esrgan_runtime, device, precision)
+
+    if runtime == "torch":
+        model = load_esrgan_checkpoint(model_path)
+        model = to_channels_last(model.to(device).to(dtype))
+        record_network_device("esrgan", f"{device.type.upper()} torch {precision}")
+
+        return model, device
+
+    # Traced network skips Python dispatch of every layer and loads faster than checkpoint
+    if is_export_stale(model_path, runtime):
+        export_network(load_esrgan_checkpoint(model_path), model_path, runtime, esrgan_calibration_folder)
+
+    if runtime != "torchscript":
         device = torch.device("cpu")
-    # device = torch.device('cpu')
+        precision = "int8" if runtime == "int8" else "fp32"
+
+    record_network_device("esrgan", f"{device.type.upper()} {runtime} {precision}")
+
+    return load_exported_network(model_path, runtime, device, dtype), device
+
+
+def get_interpolated_esrgan_network(alpha, device, dtype):
+    # alpha 0 is RRDB_PSNR, 1 is RRDB_ESRGAN, blended networks are cached, so moving slider back is instant
+    alpha = round(alpha, 2)
+    key = (alpha, str(device), dtype)
+
+    if key in esrgan_interp_networks:
+        esrgan_interp_networks.move_to_end(key)
+        return esrgan_interp_networks[key]
 
-    test_img_folder = "LR/*"
+    if len(esrgan_interp_weights) == 0:
+        esrgan_interp_weights["PSNR"] = torch.load("models/esrgan/RRDB_PSNR_x4_old_arch.pth", map_location="cpu")
+        esrgan_interp_weights["ESRGAN"] = torch.load("models/esrgan/RRDB_ESRGAN_x4_old_arch.pth", map_location="cpu")
 
+    weights_psnr = esrgan_interp_weights["PSNR"]
+    weights_esrgan = esrgan_interp_weights["ESRGAN"]
+    model = create_esrgan_network(
+        {k: torch.lerp(v_psnr, weights_esrgan[k], alpha) for k, v_psnr in weights_psnr.items()}
+    )
+    model = to_channels_last(model.to(device).to(dtype))
+
+    esrgan_interp_networks[key] = model
+
+    if len(esrgan_interp_networks) > esrgan_interp_cache_size:
+        esrgan_interp_networks.popitem(last=False)
+
+    return model
+
+
+def load_esrgan_checkpoint(model_path):
+    return create_esrgan_network(torch.load(model_path, map_location="cpu"))
+
+
+def create_esrgan_network(state_dict):
     model = arch.RRDB_Net(
         3,
         3,
@@ -211,31 +302,29 @@ def initialize_esrgan_network(model_type, use_cuda):
         res_scale=1,
         upsample_mode="upconv",
     )
-    model.load_state_dict(torch.load(model_path), strict=True)
+    model.load_state_dict(state_dict, strict=True)
     model.eval()
     for k, v in model.named_parameters():
         v.requires_grad = False
-    model = model.to(device)
 
-    return model, device
+    return model
+
 
+def initialize_dain_network():
+    # DAIN layers are CUDA extensions, without GPU frame interpolation is unavailable and network is None
+    if select_torch_device("dain").type != "cuda":
+        record_network_device("dain", "unavailable, needs CUDA")
+        return None
 
-def initialize_dain_network(use_cuda):
     torch.backends.cudnn.benchmark = True
     model = DAIN.networks.__dict__['DAIN'](channel=3, filter_size=4, timestep=0.5, training=False)
-
-    if use_cuda:
-        model = model.cuda()
+    model = model.cuda()
 
     SAVED_MODEL = 'DAIN/model_weights/best.pth'
     if os.path.exists(SAVED_MODEL):
         print("The testing model weight is: " + SAVED_MODEL)
-        if not use_cuda:
-            pretrained_dict = torch.load(SAVED_MODEL, map_location=lambda storage, loc: storage)
-            # model.load_state_dict(torch.load(args.SAVED_MODEL, map_location=lambda storage, loc: storage))
-        else:
-            pretrained_dict = torch.load(SAVED_MODEL)
-            # model.load_state_dict(torch.load(args.SAVED_MODEL))
+        pretrained_dict = torch.load(SAVED_MODEL)
+        # model.load_state_dict(torch.load(args.SAVED_MODEL))
 
         model_dict = model.state_dict()
         # 1. filter out unnecessary keys
@@ -260,12 +349,32 @@ def initialize_dain_network(use_cuda):
 
 
 def find_yolo_classes(input_frame, yolo_network, output_layers, confidence_value):
-    classes_out = []
     height, width, channels = input_frame.shape
     blob = cv2.dnn.blobFromImage(input_frame, 0.003, (608, 608), (0, 0, 0), True, crop=False)
     yolo_network.setInput(blob)
     outs = yolo_network.forward(output_layers)
 
+    return parse_yolo_outputs(outs, width, height, confidence_value)
+
+
+def find_yolo_classes_batch(input_frames, yolo_network, output_layers, confidence_value):
+    # Same as find_yolo_classes, but runs a list of equally sized frames as one NCHW blob
+    height, width, channels = input_frames[0].shape
+    blob = cv2.dnn.blobFromImages(input_frames, 0.003, (608, 608), (0, 0, 0), True, crop=False)
+    yolo_network.setInput(blob)
+    outs = yolo_network.forward(output_layers)
+
+    # Output layers stack detections of all frames together, split them back per frame
+    outs = [out.reshape(len(input_frames), -1, out.shape[-1]) for out in outs]
+
+    return [
+        parse_yolo_outputs([out[k] for out in outs], width, height, confidence_value)
+        for k in range(len(input_frames))
+    ]
+
+
+def parse_yolo_outputs(outs, width, height, confidence_value):
+    classes_out = []
     class_ids = []
     confidences = []
     boxes = []
@@ -311,6 +420,90 @@ def find_rcnn_classes(input_frame, rcnn_network):
     return boxes, masks, labels, colors
 
 
+def find_rcnn_classes_batch(input_frames, rcnn_network):
+    # Same as find_rcnn_classes, but runs a list of equally sized frames as one NCHW blob
+    labels_path = "models/mask-rcnn/object_detection_classes_coco.txt"
+    labels = open(labels_path).read().strip().split("\n")
+
+    np.random.seed(46)
+    colors = np.random.randint(0, 255, size=(len(labels), 3), dtype="uint8")
+    blob = cv2.dnn.blobFromImages(input_frames, swapRB=True, crop=False)
+    rcnn_network.setInput(blob)
+    (boxes, masks) = rcnn_network.forward(["detection_out_final", "detection_masks"])
+
+    results = []
+
+    for k in range(len(input_frames)):
+        # First value of every detection is the index of its frame in the batch
+        rows = np.where(boxes[0, 0, :, 0] == k)[0]
+        results.append((boxes[:, :, rows], masks[rows], labels, colors))
+
+    return results
+
+
+def build_rcnn_label_map(frame_shape, boxes, masks, confidence_value, mask_threshold,
+                         labels=None, label_filter=None, size_divider=0):
+    # Composite all confident Mask R-CNN detections into one full-frame label map.
+    # label_map holds the index into class_ids of the object covering each pixel, -1 for background.
+    # Later detections overwrite earlier ones where masks overlap.
+    # size_divider shrinks every box by 1/size_divider around its center before placing the mask.
+    # kept_boxes holds (confidence, start_x, start_y, box_w, box_h) of unshrunk box for every class_ids entry.
+    (H, W) = frame_shape[:2]
+    label_map = np.full((H, W), -1, np.int16)
+    class_ids = []
+    kept_boxes = []
+
+    detections = boxes[0, 0]
+    confident = np.where(detections[:, 2] > confidence_value)[0]
+    rects = (detections[confident, 3:7] * np.array([W, H, W, H])).astype("int")
+
+    for i, (start_x, start_y, end_x, end_y) in zip(confident, rects):
+        class_id = int(detections[i, 1])
+
+        if label_filter is not None and labels[class_id] not in label_filter:
+            continue
+
+        box_w = end_x - start_x
+        box_h = end_y - start_y
+        box = (detections[i, 2], start_x, start_y, box_w, box_h)
+
+        if size_divider:
+            smaller_x = int(box_w / size_divider)
+            smaller_y = int(box_h / size_divider)
+
+            if smaller_x % 2 != 0:
+                smaller_x += 1
+            if smaller_y % 2 != 0:
+                smaller_y += 1
+
+            if box_w > smaller_x:
+                box_w -= smaller_x
+                start_x += smaller_x // 2
+            if box_h > smaller_y:
+                box_h -= smaller_y
+                start_y += smaller_y // 2
+
+        if box_w <= 0 or box_h <= 0:
+            continue
+
+        mask = cv2.resize(masks[i, class_id], (box_w, box_h), interpolation=cv2.INTER_CUBIC)
+        mask = mask > mask_threshold
+
+        # Clip box to frame borders
+        x0, y0 = max(start_x, 0), max(start_y, 0)
+        x1, y1 = min(start_x + box_w, W), min(start_y + box_h, H)
+
+        if x0 >= x1 or y0 >= y1:
+            continue
+
+        mask = mask[y0 - start_y: y1 - start_y, x0 - start_x: x1 - start_x]
+        label_map[y0:y1, x0:x1][mask] = len(class_ids)
+        class_ids.append(class_id)
+        kept_boxes.append(box)
+
+    return label_map, class_ids, kept_boxes
+
+
 def extract_objects_yolo(
         input_frame,
         boxes,
@@ -392,9 +585,7 @@ def extract_objects_yolo(
                     and zip_is_opened
                     and source_mode in ("video", "youtube", "ipcam")
             ):
-                cv2.imwrite(f"static/user_renders/{label}{str(object_index)}.jpg", crop_img)
-                zip_archive.write(f"static/user_renders/{label}{str(object_index)}.jpg")
-                os.remove(f"static/user_renders/{label}{str(object_index)}.jpg")
+                zip_archive.add(f"static/user_renders/{label}{str(object_index)}.jpg", label, (x, y, w, h), crop_img)
 
             if (
                     started_rendering_mode
@@ -402,9 +593,7 @@ def extract_objects_yolo(
                     and source_mode == "image"
                     and zipped_images == False
             ):
-                cv2.imwrite(f"static/user_renders/{label}{str(object_index)}.jpg", crop_img)
-                zip_archive.write(f"static/user_renders/{label}{str(object_index)}.jpg")
-                os.remove(f"static/user_renders/{label}{str(object_index)}.jpg")
+                zip_archive.add(f"static/user_renders/{label}{str(object_index)}.jpg", label, (x, y, w, h), crop_img)
 
             object_index += 1
 
@@ -434,6 +623,8 @@ def objects_to_text_yolo(
     global object_index
 
     font_size /= 10
+    render_str = "abcdefghijklmnopqrstuvwxyz0123456789"
+    atlas = get_glyph_atlas(render_str, font_size, ascii_thickness_value)
 
     for i in range(len(boxes)):
         if i in indexes:
@@ -447,27 +638,21 @@ def objects_to_text_yolo(
                 y = 0
 
             crop_img = input_frame[y: y + h, x: x + w]
+
+            if crop_img.size == 0:
+                continue
+
             crop_img = cv2.GaussianBlur(crop_img, (blur_value, blur_value), blur_value)
-            render_str = "abcdefghijklmnopqrstuvwxyz0123456789"
-
-            if (x >= 0) & (y >= 0):
-                for xx in range(0, crop_img.shape[1], ascii_distance_value):
-                    for yy in range(0, crop_img.shape[0], ascii_distance_value):
-                        # char = randint(0, 1)
-                        pixel_b, pixel_g, pixel_r = crop_img[yy, xx]
-                        char = render_str[randint(0, len(render_str)) - 1]
-                        cv2.putText(
-                            crop_img,
-                            str(char),
-                            (xx, yy),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            font_size,
-                            (int(pixel_b), int(pixel_g), int(pixel_r)),
-                            ascii_thickness_value, lineType=cv2.LINE_AA
-                        )
-            blk = np.zeros(input_frame.shape, np.uint8)
 
-            cv2.rectangle(blk, (x, y), (x + w, y + h), (0, 255, 0), cv2.FILLED)
+            # Random glyph for every cell of box, drawn over blurred box
+            cell_colors = crop_img[::ascii_distance_value, ::ascii_distance_value]
+            char_indices = np.random.randint(0, len(render_str), cell_colors.shape[:2])
+            glyph_layer, coverage = paint_glyph_grid(
+                crop_img.shape, char_indices, cell_colors, ascii_distance_value, atlas
+            )
+            crop_img = cv2.multiply(crop_img, cv2.cvtColor(255 - coverage, cv2.COLOR_GRAY2BGR), scale=1 / 255)
+            crop_img = cv2.add(crop_img, glyph_layer)
+
             input_frame[y: y + h, x: x + w] = crop_img
 
             object_index += 1
@@ -479,6 +664,7 @@ def canny_people_on_black_yolo(input_frame, boxes, indexes, class_ids):
     global object_index
     input_frame_copy = input_frame
     input_frame = np.zeros((input_frame.shape[0], input_frame.shape[1], 3), np.uint8)
+    frame_blurred, frame_canny = get_edge_map(input_frame_copy, 5)
 
     for i in range(len(boxes)):
         if i in indexes:
@@ -493,9 +679,8 @@ def canny_people_on_black_yolo(input_frame, boxes, indexes, class_ids):
 
             crop_img = input_frame_copy[y: y + h, x: x + w]
 
-            cv2.imshow("df", crop_img)
-            crop_img = cv2.GaussianBlur(crop_img, (5, 5), 5)
-            crop_img = auto_canny(crop_img)
+            show_preview("df", crop_img)
+            crop_img = frame_canny[y: y + h, x: x + w]
 
             blank_image = np.zeros((crop_img.shape[0], crop_img.shape[1], 3), np.uint8)
 
@@ -699,6 +884,7 @@ def canny_people_on_background_yolo(input_frame, boxes, indexes, class_ids):
     # input_frame_copy = input_frame
     # input_frame = np.zeros(
     # 	(input_frame.shape[0], input_frame.shape[1], 3), np.uint8)
+    frame_blurred, frame_canny = get_edge_map(input_frame, 5)
 
     for i in range(len(boxes)):
         if i in indexes:
@@ -714,9 +900,8 @@ def canny_people_on_background_yolo(input_frame, boxes, indexes, class_ids):
             crop_img = input_frame[y: y + h, x: x + w]
 
             # crop_img = cv2.cvtColor(crop_img, cv2.COLOR_BGR2GRAY)
-            cv2.imshow("df", crop_img)
-            crop_img = cv2.GaussianBlur(crop_img, (5, 5), 5)
-            crop_img = auto_canny(crop_img)
+            show_preview("df", crop_img)
+            crop_img = frame_canny[y: y + h, x: x + w]
             # crop_img = cv2.Canny(crop_img, 100, 200)
             blank_image = np.zeros((crop_img.shape[0], crop_img.shape[1], 3), np.uint8)
 
@@ -795,40 +980,11 @@ def extract_and_cut_background_rcnn(
         input_frame, boxes, masks, labels, confidence_value
 ):
     confidence_value /= 100
-    classes_out = []
-    frame_canny = auto_canny(input_frame)
-    frame_canny = cv2.cvtColor(frame_canny, cv2.COLOR_GRAY2RGB)
-    input_frame = np.zeros(input_frame.shape, np.uint8)
-    frame_canny *= np.array((1, 1, 0), np.uint8)
-
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
-
-        if confidence > confidence_value:
-            classes_out.append(class_id)
-
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
-
-            box_w = end_x - start_x
-            box_h = end_y - start_y
-
-            mask = masks[i, class_id]
-            mask = cv2.resize(mask, (box_w, box_h), interpolation=cv2.INTER_CUBIC)
-            mask = mask > 0.1
-
-            # if (labels[class_id] == "person"):
-            frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-            frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 255)
-            input_frame[start_y:end_y, start_x:end_x][mask] = frm
-            # else:
-            # frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-            # frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 255)
-            # input_frame[start_y:end_y, start_x:end_x][mask] = frm
+    frame_blurred, frame_canny = get_edge_map(input_frame)
+    label_map, class_ids, _ = build_rcnn_label_map(input_frame.shape, boxes, masks, confidence_value, 0.1)
 
-    frame_out = input_frame
+    frame_out = np.zeros(input_frame.shape, np.uint8)
+    frame_out[(frame_canny > 0) & (label_map >= 0)] = (0, 255, 255)
 
     return frame_out
 
@@ -847,65 +1003,23 @@ def extract_and_replace_background_rcnn(
         line_thickness
 ):
     confidence_value /= 100
-    classes_out = []
-    frame_copy = input_frame
 
     frame_background = cv2.resize(frame_background, (input_frame.shape[1], input_frame.shape[0]))
-    frame_copy = cv2.resize(frame_copy, (1280, 720))
 
-    input_frame = cv2.GaussianBlur(input_frame, (canny_blur, canny_blur), canny_blur)
-    frame_canny = cv2.Canny(input_frame, canny_thres1, canny_thres2)
-    kernel = np.ones((2, 2),
-                     np.uint8)
+    input_frame, frame_canny = get_edge_map(input_frame, canny_blur, canny_thres1, canny_thres2)
+    kernel = np.ones((2, 2), np.uint8)
+    frame_canny = cv2.dilate(frame_canny, kernel, iterations=1)
+    # Lines are thickened along rows in whole frame before masking, so at mask borders they also
+    # grow from edges just outside objects, unlike old dilation of masked pixels of each object
+    kernel = np.ones((1, line_thickness), np.uint8)
     frame_canny = cv2.dilate(frame_canny, kernel, iterations=1)
-    # frame_canny = auto_canny(input_frame)
 
-    frame_canny = cv2.cvtColor(frame_canny, cv2.COLOR_GRAY2RGB)
+    label_map, class_ids, _ = build_rcnn_label_map(input_frame.shape, boxes, masks, confidence_value, 0.1)
+
     frame_out = np.zeros(input_frame.shape, np.uint8)
-    input_frame = np.zeros(input_frame.shape, np.uint8)
-    frame_canny *= np.array((1, 0, 1), np.uint8)
-
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
-
-        if confidence > confidence_value:
-            classes_out.append(class_id)
-
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
-
-            box_w = end_x - start_x
-            box_h = end_y - start_y
-
-            mask = masks[i, class_id]
-            mask = cv2.resize(mask, (box_w, box_h), interpolation=cv2.INTER_CUBIC)
-            mask = mask > 0.1
-
-            color = colors[class_id]
-
-            # if (labels[class_id] == "person"):
-            frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-            kernel = np.ones((line_thickness), np.uint8)
-            frm = cv2.dilate(frm, kernel, iterations=1)
-            frm[np.all(frm == (255, 0, 255), axis=-1)] = (255, 255, 0)
-            input_frame[start_y:end_y, start_x:end_x][mask] = frm
-            # if (labels[class_id] == "car"):
-            # frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-            # frm[np.all(frm == (255, 0, 255), axis=-1)] = (255, 0, 255)
-            # input_frame[start_y:end_y, start_x:end_x][mask] = frm
-            # else:
-            #     frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-            #     frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 255)
-            #     input_frame[start_y:end_y, start_x:end_x][mask] = frm
-
-    # text = "{}[{:.2f}]".format(LABELS[class_id], confidence)
-    # font_size = (np.sqrt(box_w * box_h) / 200)
-    # cv2.putText(frame_canny, text, (start_x, start_y - 50),
-    # cv2.FONT_HERSHEY_SIMPLEX, font_size, (255,255,255), 2)
-
-    frame_out = cv2.addWeighted(input_frame, 1, frame_background, 1, 0)
+    frame_out[(frame_canny > 0) & (label_map >= 0)] = (255, 255, 0)
+
+    frame_out = cv2.addWeighted(frame_out, 1, frame_background, 1, 0)
     return frame_out
 
 
@@ -922,454 +1036,468 @@ def color_canny_rcnn(
         line_thickness
 ):
     confidence_value /= 100
-    classes_out = []
-    # frame_canny = auto_canny(input_frame)
-    input_frame = cv2.GaussianBlur(input_frame, (canny_blur, canny_blur), canny_blur)
+    input_frame, frame_canny = get_edge_map(input_frame, canny_blur, canny_thres1, canny_thres2)
 
-    frame_canny = cv2.Canny(input_frame, canny_thres1, canny_thres2)
-    # frame_canny = auto_canny(input_frame, 0)
+    label_map, class_ids, kept_boxes = build_rcnn_label_map(
+        input_frame.shape, boxes, masks, confidence_value, 0.1, labels, ("person", "car")
+    )
 
-    frame_canny = cv2.cvtColor(frame_canny, cv2.COLOR_GRAY2BGR)
-    frame_out = np.zeros(input_frame.shape, np.uint8)
+    kernel = np.ones((1, line_thickness), np.uint8)
+    object_edges = cv2.dilate(frame_canny, kernel, iterations=1)
 
-    input_frame = np.zeros(input_frame.shape, np.uint8)
-    frame_canny *= np.array((1, 1, 0), np.uint8)
+    # Last palette row is black, so background pixels (label -1) pick it up
+    palette = [(0, 255, 0) if labels[class_id] == "person" else (255, 0, 255) for class_id in class_ids]
+    palette = np.array(palette + [(0, 0, 0)], np.uint8)
+    input_frame = palette[label_map]
+    input_frame[object_edges == 0] = 0
 
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
+    # Glow of edges in blue and green channels, blurred once for both
+    frame_canny = cv2.GaussianBlur(
+        frame_canny, (rcnn_blur_value, rcnn_blur_value), rcnn_blur_value
+    )
+    frame_canny = cv2.merge((frame_canny, frame_canny, np.zeros_like(frame_canny)))
 
-        if confidence > confidence_value:
-            classes_out.append(class_id)
+    # Labels of outlined objects, drawn from boxes kept in label map
+    for class_id, (confidence, start_x, start_y, box_w, box_h) in zip(class_ids, kept_boxes):
+        if confidence > 0.5:
+            text = "{}[{:.2f}]".format(labels[class_id], confidence)
+            font_size = np.sqrt(box_w * box_h) / 200
+            color = (0, 255, 255) if labels[class_id] == "person" else (255, 0, 255)
+            cv2.putText(frame_canny, text, (start_x, start_y - 50), cv2.FONT_HERSHEY_SIMPLEX, font_size, color, 2)
 
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
+    frame_out = np.bitwise_or(input_frame, frame_canny)
+    return frame_out
 
-            box_w = end_x - start_x
-            box_h = end_y - start_y
 
-            mask = masks[i, class_id]
-            mask = cv2.resize(mask, (box_w, box_h), interpolation=cv2.INTER_CUBIC)
-            mask = mask > 0.1
+def color_canny_on_color_background_rcnn(input_frame, boxes, masks, labels, confidence_value):
+    confidence_value /= 100
+    frame_blurred, frame_canny = get_edge_map(input_frame)
+    label_map, class_ids, _ = build_rcnn_label_map(input_frame.shape, boxes, masks, confidence_value, 0.5)
 
-            if (labels[class_id] == "person"):
-                frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-                kernel = np.ones((line_thickness), np.uint8)
-                frm = cv2.dilate(frm, kernel, iterations=1)
-                frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 0)
-                input_frame[start_y:end_y, start_x:end_x][mask] = frm
+    # Last palette row is unused filler for background pixels (label -1)
+    palette = [(0, 255, 255) if labels[class_id] == "person" else (0, 255, 0) for class_id in class_ids]
+    palette = np.array(palette + [(0, 0, 0)], np.uint8)
+    objects = palette[label_map]
+    objects[frame_canny == 0] = 0
 
-            if (labels[class_id] == "car"):
-                frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-                kernel = np.ones((line_thickness), np.uint8)
-                frm = cv2.dilate(frm, kernel, iterations=1)
-                frm[np.all(frm == (255, 255, 0), axis=-1)] = (255, 0, 255)
-                input_frame[start_y:end_y, start_x:end_x][mask] = frm
+    in_objects = label_map >= 0
+    input_frame[in_objects] = objects[in_objects]
 
-    # frame_out = cv2.addWeighted(input_frame, 1, frame_canny, 1, 0)
-    frame_canny = cv2.GaussianBlur(
-        frame_canny, (rcnn_blur_value, rcnn_blur_value), rcnn_blur_value
-    )
+    frame_out = input_frame
+    return frame_out
 
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
 
-        if confidence > 0.5:
-            classes_out.append(class_id)
+def colorizer_people_rcnn(input_frame, boxes, masks, confidence_value, rcnn_size_value, rcnn_blur_value):
+    confidence_value /= 100
 
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
+    if rcnn_size_value == 0:
+        rcnn_size_value = 2
 
-            box_w = end_x - start_x
-            box_h = end_y - start_y
+    label_map, class_ids, _ = build_rcnn_label_map(
+        input_frame.shape, boxes, masks, confidence_value, 0.2, size_divider=rcnn_size_value
+    )
 
-            if labels[class_id] == "person":
-                text = "{}[{:.2f}]".format(labels[class_id], confidence)
-                font_size = np.sqrt(box_w * box_h) / 200
-                cv2.putText(
-                    frame_canny,
-                    text,
-                    (start_x, start_y - 50),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    font_size,
-                    (0, 255, 255),
-                    2,
-                )
-            if labels[class_id] == "car":
-                text = "{}[{:.2f}]".format(labels[class_id], confidence)
-                font_size = np.sqrt(box_w * box_h) / 200
-                cv2.putText(
-                    frame_canny,
-                    text,
-                    (start_x, start_y - 50),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    font_size,
-                    (255, 0, 255),
-                    2,
-                )
-            if labels[class_id] == "truck":
-                text = "{}[{:.2f}]".format(labels[class_id], confidence)
-                font_size = np.sqrt(box_w * box_h) / 200
-                cv2.putText(
-                    frame_canny,
-                    text,
-                    (start_x, start_y - 50),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    font_size,
-                    (255, 0, 255),
-                    2,
-                )
-            if labels[class_id] == "bus":
-                text = "{}[{:.2f}]".format(labels[class_id], confidence)
-                font_size = np.sqrt(box_w * box_h) / 200
-                cv2.putText(
-                    frame_canny,
-                    text,
-                    (start_x, start_y - 50),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    font_size,
-                    (255, 0, 255),
-                    2,
-                )
+    frame_out = cv2.cvtColor(input_frame, cv2.COLOR_BGR2GRAY)
+    frame_out = cv2.GaussianBlur(frame_out, (rcnn_blur_value, rcnn_blur_value), rcnn_blur_value)
+    frame_out = cv2.cvtColor(frame_out, cv2.COLOR_GRAY2BGR)
+
+    in_objects = label_map >= 0
+    frame_out[in_objects] = input_frame[in_objects]
 
-    frame_out = np.bitwise_or(input_frame, frame_canny)
     return frame_out
 
 
-def color_canny_on_color_background_rcnn(input_frame, boxes, masks, labels, confidence_value):
+def colorizer_people_with_blur_rcnn(input_frame, boxes, masks, confidence_value):
     confidence_value /= 100
-    classes_out = []
-    frame_canny = auto_canny(input_frame)
-    frame_canny = cv2.cvtColor(frame_canny, cv2.COLOR_GRAY2RGB)
-    frame_copy = input_frame
-    frame_out = np.zeros(input_frame.shape, np.uint8)
-    frame_canny *= np.array((1, 1, 0), np.uint8)
 
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
+    label_map, class_ids, _ = build_rcnn_label_map(
+        input_frame.shape, boxes, masks, confidence_value, 0.1, size_divider=10
+    )
 
-        if confidence > confidence_value:
-            classes_out.append(class_id)
+    frame_out = cv2.cvtColor(input_frame, cv2.COLOR_BGR2GRAY)
+    frame_out = cv2.GaussianBlur(frame_out, (17, 17), 17)
+    frame_out = cv2.cvtColor(frame_out, cv2.COLOR_GRAY2BGR)
 
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
+    in_objects = label_map >= 0
+    frame_out[in_objects] = input_frame[in_objects]
 
-            box_w = end_x - start_x
-            box_h = end_y - start_y
+    return frame_out
 
-            mask = masks[i, class_id]
-            mask = cv2.resize(mask, (box_w, box_h), interpolation=cv2.INTER_CUBIC)
-            mask = mask > 0.5
 
-            if labels[class_id] == "person":
-                frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-                frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 255)
-                input_frame[start_y:end_y, start_x:end_x][mask] = frm
-            else:
-                frm = frame_canny[start_y:end_y, start_x:end_x][mask]
-                frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 0)
-                input_frame[start_y:end_y, start_x:end_x][mask] = frm
+def people_with_blur_rcnn(input_frame, boxes, masks, labels, confidence_value, rcnn_size_value, rcnn_blur_value):
+    confidence_value /= 100
+
+    if rcnn_size_value == 0:
+        rcnn_size_value = 2
+
+    label_map, class_ids, _ = build_rcnn_label_map(
+        input_frame.shape, boxes, masks, confidence_value, 0.1, size_divider=rcnn_size_value
+    )
+
+    frame_out = cv2.GaussianBlur(input_frame, (rcnn_blur_value, rcnn_blur_value), rcnn_blur_value)
+
+    in_objects = label_map >= 0
+    frame_out[in_objects] = input_frame[in_objects]
 
-    # frame_out = cv2.addWeighted(input_frame, 1, frame_canny, 1, 0)
-    # frame_out = np.bitwise_xor(input_frame, frame_canny)
-    frame_out = input_frame
     return frame_out
 
 
-def colorizer_people_rcnn(input_frame, boxes, masks, confidence_value, rcnn_size_value, rcnn_blur_value):
-    confidence_value /= 100
-    classes_out = []
-    need_gray_to_bgr = True
-    already_bgr = False
-    frame_copy = input_frame
+def colorizer_caffe(net, image, interval=1, history_key="caffe_colorization"):
+    # Network runs on every interval-th frame, chroma of frames between is warped from last one
+    L, gray = prepare_caffe_input(image)
 
-    # hsvImg = cv2.cvtColor(frame_copy, cv2.COLOR_BGR2HSV)
-    # hsvImg[..., 1] = hsvImg[..., 1] * 1.1
-    # # hsvImg[...,2] = hsvImg[...,2]*0.6
-    # frame_copy = cv2.cvtColor(hsvImg, cv2.COLOR_HSV2BGR)
+    with caffe_lock:
+        history = caffe_history.get(history_key)
 
-    input_frame = cv2.cvtColor(input_frame, cv2.COLOR_BGR2GRAY)
-    input_frame = cv2.GaussianBlur(input_frame, (rcnn_blur_value, rcnn_blur_value), rcnn_blur_value)
-    frame_canny = auto_canny(input_frame)
-    frame_canny = cv2.cvtColor(frame_canny, cv2.COLOR_GRAY2RGB)
-    frame_canny *= np.array((1, 1, 0), np.uint8)
+    if history is None or history["count"] >= interval:
+        net.setInput(cv2.dnn.blobFromImage(L))
+        ab = net.forward()[0, :, :, :].transpose((1, 2, 0))
+        count = 1
+    else:
+        ab = propagate_chroma(history["gray"], history["ab"], gray)
+        count = history["count"] + 1
 
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
+    with caffe_lock:
+        caffe_history[history_key] = {"gray": gray, "ab": ab, "count": count}
 
-        if confidence > confidence_value:
-            classes_out.append(class_id)
+    return finish_caffe_output(image, ab)
 
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
 
-            box_w = end_x - start_x
-            box_h = end_y - start_y
+def reset_caffe_history():
+    # Chroma of last colorized frame doesn't fit frames after seek, from other source or mode
+    with caffe_lock:
+        caffe_history.clear()
 
-            if rcnn_size_value == 0:
-                rcnn_size_value = 2
 
-            smaller_x = int(box_w / rcnn_size_value)
-            smaller_y = int(box_h / rcnn_size_value)
+def colorizer_caffe_batch(net, images, interval=1, history_key="caffe_colorization"):
+    # Same as colorizer_caffe, but runs L channels of every interval-th frame through the network as one blob
+    # Interval continues from last frame of previous batch, kept in same history as colorizer_caffe
+    inputs = [prepare_caffe_input(image) for image in images]
 
-            if smaller_x % 2 != 0:
-                smaller_x += 1
-            if smaller_y % 2 != 0:
-                smaller_y += 1
+    with caffe_lock:
+        history = caffe_history.get(history_key)
 
-            if box_w > smaller_x:
-                box_w -= smaller_x
-            else:
-                smaller_x = 0
+    count = interval if history is None else history["count"]
+    counts = []
 
-            if box_h > smaller_y:
-                box_h -= smaller_y
-            else:
-                smaller_y = 0
+    for k in range(len(images)):
+        count = 1 if count >= interval else count + 1
+        counts.append(count)
 
-            mask = masks[i, class_id]
-            mask = cv2.resize(mask, (box_w, box_h), interpolation=cv2.INTER_CUBIC)
-            mask = mask > 0.2
+    inferred = [k for k in range(len(images)) if counts[k] == 1]
+    ab_batch = {}
 
-            frm = frame_copy[
-                  start_y + int(smaller_y / 2): end_y - int(smaller_y / 2),
-                  start_x + int(smaller_x / 2): end_x - int(smaller_x / 2),
-                  ][mask]
-            frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 255)
+    if len(inferred) > 0:
+        net.setInput(cv2.dnn.blobFromImages([inputs[k][0] for k in inferred]))
+        ab_batch = dict(zip(inferred, net.forward().transpose((0, 2, 3, 1))))
 
-            if already_bgr == False:
-                input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2BGR)
-                already_bgr = True
+    results = []
 
-            input_frame[
-            start_y + int(smaller_y / 2): end_y - int(smaller_y / 2),
-            start_x + int(smaller_x / 2): end_x - int(smaller_x / 2),
-            ][mask] = frm
+    for k, image in enumerate(images):
+        if k not in ab_batch:
+            (previous_gray, previous_ab) = (inputs[k - 1][1], ab_batch[k - 1]) if k > 0 else \
+                (history["gray"], history["ab"])
+            ab_batch[k] = propagate_chroma(previous_gray, previous_ab, inputs[k][1])
 
-            need_gray_to_bgr = False
+        results.append(finish_caffe_output(image, ab_batch[k]))
 
-    # text = "{}[{:.2f}]".format(LABELS[class_id], confidence)
-    # cv2.putText(frame_canny, text, (start_x, start_y - 50),
-    # cv2.FONT_HERSHEY_SIMPLEX, font_size, (255,255,255), 2)
+    with caffe_lock:
+        caffe_history[history_key] = {"gray": inputs[-1][1], "ab": ab_batch[len(images) - 1], "count": counts[-1]}
 
-    if need_gray_to_bgr:
-        input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2RGB)
+    return results
 
-    frame_out = input_frame
-    return frame_out
 
+def prepare_caffe_input(image):
+    # Network sees 224x224 L channel, so only downscaled frame is converted to float LAB
+    # Returns network L input and its 8 bit version for chroma propagation
+    small = cv2.resize(image, (224, 224), interpolation=cv2.INTER_AREA)
+    lab = cv2.cvtColor(small.astype(np.float32) * (1 / 255), cv2.COLOR_BGR2LAB)
+    L = lab[:, :, 0] - 50
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
 
-def colorizer_people_with_blur_rcnn(input_frame, boxes, masks, confidence_value):
-    confidence_value /= 100
-    classes_out = []
-    need_gray_to_bgr = True
-    already_bgr = False
-    frame_copy = input_frame
+    return L, gray
 
-    input_frame = cv2.cvtColor(input_frame, cv2.COLOR_BGR2GRAY)
-    input_frame = cv2.GaussianBlur(input_frame, (17, 17), 17)
-    frame_canny = auto_canny(input_frame)
-    frame_canny = cv2.cvtColor(frame_canny, cv2.COLOR_GRAY2RGB)
 
-    frame_canny *= np.array((1, 1, 0), np.uint8)
+def propagate_chroma(previous_gray, previous_ab, gray):
+    # Warps network chroma of previous frame onto current one with optical flow at network input resolution
+    # Network outputs chroma 4 times smaller than its input, so flow is scaled down to chroma grid
+    flow = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST).calc(gray, previous_gray, None)
+    (h, w) = previous_ab.shape[:2]
+    flow = cv2.resize(flow, (w, h), interpolation=cv2.INTER_AREA)
+    flow *= np.array([w / gray.shape[1], h / gray.shape[0]], np.float32)
+    grid = np.dstack(np.meshgrid(np.arange(w), np.arange(h))).astype(np.float32)
 
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
+    return cv2.remap(previous_ab, grid + flow, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
 
-        if confidence > confidence_value:
-            classes_out.append(class_id)
 
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
+def finish_caffe_output(image, ab):
+    # Only chroma is upsampled, as 8 bit, and merged with 8 bit LAB of frame, so luminance stays untouched
+    ab = np.clip(ab + 128, 0, 255).astype(np.uint8)
+    ab = cv2.resize(ab, (image.shape[1], image.shape[0]))
+    L = cv2.extractChannel(cv2.cvtColor(image, cv2.COLOR_BGR2LAB), 0)
 
-            box_w = end_x - start_x
-            box_h = end_y - start_y
+    return cv2.cvtColor(cv2.merge([L, ab]), cv2.COLOR_LAB2BGR)
 
-            smaller_x = int(box_w / 10)
-            smaller_y = int(box_h / 10)
-            # smaller_x = 0
-            # smaller_y = 0
 
-            if smaller_x % 2 != 0:
-                smaller_x += 1
-            if smaller_y % 2 != 0:
-                smaller_y += 1
+def fit_upscale_input(image, scales, target_height):
+    # Picks smallest scale reaching target output height and downscales frame first,
+    # so upscaler doesn't compute pixels that would be thrown away
+    # target_height 0 upscales frame as is with biggest scale
+    (h, w) = image.shape[:2]
+    scale = max(scales)
 
-            if box_w > smaller_x:
-                box_w -= smaller_x
-            else:
-                smaller_x = 0
+    if target_height <= 0:
+        return scale, image
 
-            if box_h > smaller_y:
-                box_h -= smaller_y
-            else:
-                smaller_y = 0
+    scale = next((scale for scale in sorted(scales) if h * scale >= target_height), scale)
 
-            mask = masks[i, class_id]
-            mask = cv2.resize(mask, (box_w, box_h), interpolation=cv2.INTER_CUBIC)
-            mask = mask > 0.1
+    if h * scale > target_height:
+        factor = target_height / (h * scale)
+        image = cv2.resize(
+            image, (max(1, round(w * factor)), max(1, round(h * factor))), interpolation=cv2.INTER_AREA
+        )
 
-            frm = frame_copy[
-                  start_y + int(smaller_y / 2): end_y - int(smaller_y / 2),
-                  start_x + int(smaller_x / 2): end_x - int(smaller_x / 2),
-                  ][mask]
-            frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 255)
+    return scale, image
 
-            if already_bgr == False:
-                input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2BGR)
-                already_bgr = True
 
-            input_frame[
-            start_y + int(smaller_y / 2): end_y - int(smaller_y / 2),
-            start_x + int(smaller_x / 2): end_x - int(smaller_x / 2),
-            ][mask] = frm
+def upscale_with_superres(networks, image, target_height=0, history_key=None):
+    scale, image = fit_upscale_input(image, networks.keys(), target_height)
+    margin = superres_margins[networks[scale].getAlgorithm()]
+    result = upscale_changed_blocks(networks[scale].upsample, networks[scale], image, history_key, margin)
+    return result
 
-            need_gray_to_bgr = False
 
-    # text = "{}[{:.2f}]".format(LABELS[class_id], confidence)
-    # cv2.putText(frame_canny, text, (start_x, start_y - 50),
-    # cv2.FONT_HERSHEY_SIMPLEX, font_size, (255,255,255), 2)
+def upscale_with_esrgan(network, device, image, target_height=0):
+    # ESRGAN sees over 100 source pixels around each output pixel, so it always upscales whole frames
+    image = fit_upscale_input(image, [4], target_height)[1]
 
-    if need_gray_to_bgr:
-        input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2RGB)
+    return upscale_esrgan_frame(network, device, image)
 
-    frame_out = input_frame
-    return frame_out
 
+def get_changed_blocks(previous_image, image, block_size, threshold):
+    # Differences are averaged in 4x4 pixels first, so sensor noise doesn't mark whole frame as changed
+    # Returns boolean grid with one value for each block_size x block_size block
+    difference = cv2.absdiff(previous_image, image)
 
-def people_with_blur_rcnn(input_frame, boxes, masks, labels, confidence_value, rcnn_size_value, rcnn_blur_value):
-    confidence_value /= 100
+    if difference.ndim == 3:
+        difference = difference.max(axis=2)
 
-    classes_out = []
-    need_gray_to_bgr = True
-    already_bgr = False
-    frame_copy = input_frame.copy()
-    # input_frame = cv2.cvtColor(input_frame, cv2.COLOR_BGR2GRAY)
-    input_frame = cv2.GaussianBlur(input_frame, (rcnn_blur_value, rcnn_blur_value), rcnn_blur_value)
-    frame_canny = auto_canny(input_frame)
-    frame_canny = cv2.cvtColor(frame_canny, cv2.COLOR_GRAY2RGB)
+    (h, w) = difference.shape
+    difference = cv2.resize(difference, (-(-w // 4), -(-h // 4)), interpolation=cv2.INTER_AREA)
+    cell = block_size // 4
+    rows = -(-difference.shape[0] // cell)
+    columns = -(-difference.shape[1] // cell)
+    padded = np.zeros((rows * cell, columns * cell), np.uint8)
+    padded[:difference.shape[0], :difference.shape[1]] = difference
 
-    frame_canny *= np.array((1, 1, 0), np.uint8)
+    return padded.reshape(rows, cell, columns, cell).max(axis=(1, 3)) > threshold
 
-    for i in range(0, boxes.shape[2]):
-        class_id = int(boxes[0, 0, i, 1])
-        confidence = boxes[0, 0, i, 2]
 
-        if confidence > confidence_value:
-            classes_out.append(class_id)
+def get_block_runs(columns):
+    # Runs of changed blocks in a row as (first, last + 1) pairs, split into runs of 4, 2 and 1 blocks,
+    # so upscaler gets only a few region shapes
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], columns.astype(np.int8), [0]))))
+    runs = []
 
-            (H, W) = input_frame.shape[:2]
-            box = boxes[0, 0, i, 3:7] * np.array([W, H, W, H])
-            (start_x, start_y, end_x, end_y) = box.astype("int")
+    for first, last in zip(edges[::2], edges[1::2]):
+        for length in (4, 2, 1):
+            while last - first >= length:
+                runs.append((first, first + length))
+                first += length
 
-            box_w = end_x - start_x
-            box_h = end_y - start_y
+    return runs
 
-            if rcnn_size_value == 0:
-                rcnn_size_value = 2
 
-            smaller_x = int(box_w / rcnn_size_value)
-            smaller_y = int(box_h / rcnn_size_value)
-            # smaller_x = 0
-            # smaller_y = 0
+def upscale_changed_blocks(upscale, upscaler, image, history_key, margin):
+    # Upscales only blocks changed since last frame and pastes them over last upscaled frame,
+    # static cameras mostly change in a few blocks. margin is receptive field of upscaler in source pixels:
+    # changed block output reaches margin into its neighbours, and every pasted pixel is computed
+    # from same source pixels as in whole frame, so pasted regions have no seams
+    # upscaler is network object, last output is not reused after network is changed
+    # history_key None upscales whole frame without history
+    if history_key is None:
+        return upscale(image)
 
-            if smaller_x % 2 != 0:
-                smaller_x += 1
-            if smaller_y % 2 != 0:
-                smaller_y += 1
+    with upscale_lock:
+        history = upscale_history.get(history_key)
 
-            if box_w > smaller_x:
-                box_w -= smaller_x
-            else:
-                smaller_x = 0
+    (h, w) = image.shape[:2]
+    regions = None
 
-            if box_h > smaller_y:
-                box_h -= smaller_y
-            else:
-                smaller_y = 0
+    if history is not None and history["upscaler"] is upscaler and history["source"].shape == image.shape:
+        changed = get_changed_blocks(history["source"], image, upscale_block_size, upscale_change_threshold)
+        regions = []
 
-            mask = masks[i, class_id].copy()
-            mask = cv2.resize(mask, (box_w, box_h), interpolation=cv2.INTER_CUBIC)
-            mask = mask > 0.1
+        for row, columns in enumerate(changed):
+            for first, last in get_block_runs(columns):
+                # Pasted region, changed blocks with margin, and source region around it
+                (y1, y2) = (max(0, row * upscale_block_size - margin), min(h, (row + 1) * upscale_block_size + margin))
+                (x1, x2) = (max(0, first * upscale_block_size - margin), min(w, last * upscale_block_size + margin))
+                regions.append((y1, y2, x1, x2, max(0, y1 - margin), max(0, x1 - margin)))
 
-            # if (labels[class_id] == "person"):
-            frm = frame_copy[
-                  start_y + int(smaller_y / 2): end_y - int(smaller_y / 2),
-                  start_x + int(smaller_x / 2): end_x - int(smaller_x / 2),
-                  ][mask].copy()
-            frm[np.all(frm == (255, 255, 0), axis=-1)] = (0, 255, 255)
-            input_frame[
-            start_y + int(smaller_y / 2): end_y - int(smaller_y / 2),
-            start_x + int(smaller_x / 2): end_x - int(smaller_x / 2),
-            ][mask] = frm.copy()
+        # Whole frame is upscaled faster than regions covering most of it with their margins
+        area = sum((min(h, y2 + margin) - top) * (min(w, x2 + margin) - left)
+                   for (y1, y2, x1, x2, top, left) in regions)
 
-            # if (already_bgr == False):
-            #     input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2BGR)
-            #     already_bgr = True
+        if area > h * w * 0.75:
+            regions = None
 
-            need_gray_to_bgr = False
+    if regions is None:
+        source = image.copy()
+        output = upscale(image)
+    else:
+        source = history["source"].copy()
+        output = history["output"].copy()
+        scale = output.shape[0] // source.shape[0]
 
-    # text = "{}[{:.2f}]".format(LABELS[class_id], confidence)
-    # cv2.putText(frame_canny, text, (start_x, start_y - 50),
-    # cv2.FONT_HERSHEY_SIMPLEX, font_size, (255,255,255), 2)
+        for (y1, y2, x1, x2, top, left) in regions:
+            region = upscale(image[top: min(h, y2 + margin), left: min(w, x2 + margin)])
 
-    # if need_gray_to_bgr:
-    #     input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2RGB)
+            output[y1 * scale: y2 * scale, x1 * scale: x2 * scale] = region[
+                (y1 - top) * scale: (y2 - top) * scale, (x1 - left) * scale: (x2 - left) * scale
+            ]
+            source[y1:y2, x1:x2] = image[y1:y2, x1:x2]
 
-    frame_out = input_frame
-    return frame_out
+    # Source keeps old pixels of unchanged blocks, so slow changes add up until block is upscaled again
+    with upscale_lock:
+        upscale_history[history_key] = {"upscaler": upscaler, "source": source, "output": output}
 
+    return output.copy()
 
-def colorizer_caffe(net, image):
-    scaled = image.astype("float32") / 255.0
-    lab = cv2.cvtColor(scaled, cv2.COLOR_BGR2LAB)
 
-    resized = cv2.resize(lab, (224, 224))
-    L = cv2.split(resized)[0]
-    L -= 50
+def upscale_esrgan_frame(network, device, image):
+    if esrgan_tile_size > 0 and max(image.shape[:2]) > esrgan_tile_size:
+        return upscale_with_esrgan_tiled(
+            network, device, image, esrgan_tile_size, esrgan_tile_overlap, esrgan_tile_workers
+        )
 
-    net.setInput(cv2.dnn.blobFromImage(L))
-    ab = net.forward()[0, :, :, :].transpose((1, 2, 0))
-    ab = cv2.resize(ab, (image.shape[1], image.shape[0]))
+    img_LR = prepare_esrgan_input(image).unsqueeze(0)
+    output = run_esrgan(network, device, img_LR)
+    # cv2.imwrite('results/{:s}_rlt.png'.format(base), output)
 
-    L = cv2.split(lab)[0]
+    return finish_esrgan_output(output)[0]
 
-    colorized = np.concatenate((L[:, :, np.newaxis], ab), axis=2)
-    colorized = cv2.cvtColor(colorized, cv2.COLOR_LAB2BGR)
-    colorized = np.clip(colorized, 0, 1)
-    colorized = (255 * colorized).astype("uint8")
 
-    # cv2.imshow("Original", image)
-    # cv2.imshow("Colorized", colorized)
-    # cv2.waitKey(0)
-    return colorized
+def upscale_with_esrgan_batch(network, device, images, target_height=0):
+    # Same as upscale_with_esrgan, but runs a list of equally sized frames as one NCHW tensor
+    # Frames upscaled in tiles go one by one, tiles already fill the network
+    images = [fit_upscale_input(image, [4], target_height)[1] for image in images]
 
+    if esrgan_tile_size > 0 and max(images[0].shape[:2]) > esrgan_tile_size:
+        return [upscale_esrgan_frame(network, device, image) for image in images]
 
-def upscale_with_superres(network, image):
-    # result = cv2.resize(image, (round(image.shape[1]*resize_value), round(image.shape[0]*resize_value)))
-    result = network.upsample(image)
-    return result
+    img_LR = torch.stack([prepare_esrgan_input(image) for image in images])
+    output = run_esrgan(network, device, img_LR)
 
+    return list(finish_esrgan_output(output))
 
-def upscale_with_esrgan(network, device, image):
-    image = image * 1.0 / 255
-    image = torch.from_numpy(np.transpose(image[:, :, [2, 1, 0]], (2, 0, 1))).float()
-    img_LR = image.unsqueeze(0)
-    img_LR = img_LR.to(device)
 
-    output = network(img_LR).data.squeeze().float().cpu().clamp_(0, 1).numpy()
-    output = np.transpose(output[[2, 1, 0], :, :], (1, 2, 0))
-    output = (output * 255.0).round()
-    # cv2.imwrite('results/{:s}_rlt.png'.format(base), output)
+def set_esrgan_options(tile_size, overlap, workers, precision="auto", runtime="auto", calibration_folder="images"):
+    # tile_size 0 upscales whole frames at once
+    # precision "auto" is fp16 on CUDA and fp32 on CPU, "fp32", "fp16" or "bf16" force it
+    # runtime "torch" runs eager network, "torchscript", "onnxruntime", "opencv" or "auto" run exported one,
+    # "int8" runs network quantized on CPU, calibrated on images from calibration_folder
+    global esrgan_tile_size, esrgan_tile_overlap, esrgan_tile_workers, esrgan_precision, esrgan_runtime
+    global esrgan_calibration_folder
+    esrgan_tile_size = tile_size
+    esrgan_tile_overlap = min(overlap, tile_size // 2)
+    esrgan_tile_workers = max(1, workers)
+    esrgan_precision = precision
+    esrgan_runtime = runtime
+    esrgan_calibration_folder = calibration_folder
+
+
+def get_tile_starts(length, tile_size, overlap):
+    # Start positions of tiles covering length, neighbouring tiles overlap by at least overlap
+    if length <= tile_size:
+        return [0]
+
+    return list(range(0, length - tile_size, tile_size - overlap)) + [length - tile_size]
+
+
+def get_tile_weights(start, end, length, overlap, scale):
+    # Blending weights along one tile side: linear ramps over overlap where other tiles continue, 1 elsewhere
+    weights = torch.ones((end - start) * scale)
+    ramp = (torch.arange(overlap * scale).float() + 0.5) / (overlap * scale)
+
+    if start > 0 and len(ramp) > 0:
+        weights[:len(ramp)] = ramp
+    if end < length and len(ramp) > 0:
+        weights[-len(ramp):] = torch.min(weights[-len(ramp):], ramp.flip(0))
+
+    return weights
+
+
+def upscale_with_esrgan_tiled(network, device, image, tile_size, overlap, workers=1):
+    # Upscale frame in overlapping tiles, so memory use doesn't depend on frame size
+    # Tile outputs are feathered together in overlaps to hide seams
+    # Output only approximates whole frame upscaling: ESRGAN sees far more pixels around each output pixel
+    # than overlap gives tiles, so pixels near tile edges differ and feathering blends these differences
+    # Bigger overlap hides seams better at cost of upscaling more pixels twice
+    scale = 4  # RRDB_Net is built with upscale=4
+    (h, w) = image.shape[:2]
+    tiles = [(y, x) for y in get_tile_starts(h, tile_size, overlap) for x in get_tile_starts(w, tile_size, overlap)]
+    img_LR = prepare_esrgan_input(image)
+
+    def upscale_tile(tile):
+        (y, x) = tile
+        return run_esrgan(network, device, img_LR[:, y: y + tile_size, x: x + tile_size].unsqueeze(0), False)[0]
+
+    # Several CPU tiles at once keep all cores busy on small convolutions
+    executor = None
+
+    if workers > 1 and device.type == "cpu":
+        executor = ThreadPoolExecutor(workers)
+        outputs = executor.map(upscale_tile, tiles)
+    else:
+        outputs = map(upscale_tile, tiles)
+
+    # Frame sized accumulators stay in memory, only finished tiles are copied from device
+    output = torch.zeros((3, h * scale, w * scale))
+    weights = torch.zeros((h * scale, w * scale))
+
+    for (y, x), tile_output in zip(tiles, outputs):
+        (tile_h, tile_w) = (tile_output.shape[1] // scale, tile_output.shape[2] // scale)
+        tile_weights = get_tile_weights(y, y + tile_h, h, overlap, scale)[:, None] * \
+            get_tile_weights(x, x + tile_w, w, overlap, scale)[None, :]
+        output[:, y * scale: (y + tile_h) * scale, x * scale: (x + tile_w) * scale] += tile_output.cpu() * tile_weights
+        weights[y * scale: (y + tile_h) * scale, x * scale: (x + tile_w) * scale] += tile_weights
+
+    if executor is not None:
+        executor.shutdown()
+
+    return finish_esrgan_output(to_uint8_tensor(output / weights).unsqueeze(0))[0]
+
+
+def prepare_esrgan_input(image):
+    # uint8 BGR frame to uint8 RGB CHW tensor, it's converted to float only on device
+    return torch.from_numpy(np.ascontiguousarray(image[:, :, ::-1].transpose(2, 0, 1)))
+
+
+def run_esrgan(network, device, img_LR, to_uint8=True):
+    # Runs uint8 NCHW batch through network in dtype and memory format of its weights
+    # Returns uint8 batch, or float32 batch in [0, 1] on device
+    # Networks run by ONNX runtimes have no torch weights and tell their input dtype
+    dtype = network.dtype if hasattr(network, "dtype") else next(network.parameters()).dtype
+    img_LR = img_LR.to(device, non_blocking=True).to(dtype).div_(255)
+    img_LR = to_channels_last(img_LR)
+
+    with torch.no_grad():
+        output = network(img_LR).float().clamp_(0, 1)
+
+    if to_uint8:
+        return to_uint8_tensor(output)
+
+    return output
+
+
+def to_uint8_tensor(output):
+    return output.mul_(255).round_().to(torch.uint8)
+
+
+def finish_esrgan_output(output):
+    # uint8 RGB NCHW batch to NHWC BGR frames, reordered on device before copy to memory
+    output = output.flip(1).permute(0, 2, 3, 1).contiguous().cpu().numpy()
 
     return output
 
@@ -1489,6 +1617,94 @@ def boost_fps_with_dain(dain_network, f, f1, fps_boost, use_cuda):
     return frame_write_sequence, frames
 
 
+def get_glyph_atlas(render_str, font_size, thickness):
+    # Rasterize every char of render_str once per font size and thickness
+    # Returns glyph alpha tiles and position of text origin inside tile
+    key = (render_str, round(font_size, 3), thickness)
+
+    if key not in glyph_atlas_cache:
+        sizes = [cv2.getTextSize(char, cv2.FONT_HERSHEY_SIMPLEX, font_size, thickness) for char in render_str]
+        padding = thickness + 2
+        origin_y = max(h for (w, h), baseline in sizes) + padding
+        tile_w = max(w for (w, h), baseline in sizes) + 2 * padding
+        tile_h = origin_y + max(baseline for (w, h), baseline in sizes) + padding
+
+        glyphs = np.zeros((len(render_str), tile_h, tile_w), np.uint8)
+
+        for i, char in enumerate(render_str):
+            cv2.putText(
+                glyphs[i],
+                char,
+                (padding, origin_y),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                font_size,
+                255,
+                thickness,
+                lineType=cv2.LINE_AA,
+            )
+
+        # Crop padding glyphs don't reach, so fewer glyphs overlap
+        x, y, w, h = cv2.boundingRect(glyphs.max(axis=0))
+        glyphs = np.ascontiguousarray(glyphs[:, y: y + h, x: x + w])
+
+        glyph_atlas_cache[key] = (glyphs, origin_y - y, padding - x)
+
+    return glyph_atlas_cache[key]
+
+
+def paint_glyph_grid(frame_shape, char_indices, cell_colors, distance, atlas):
+    # Draw glyph atlas[char_indices[row, col]] colored with cell_colors[row, col]
+    # with text origin at (col * distance, row * distance) on black frame
+    # Returns colored glyphs and their coverage for blending over other frame
+    glyphs, origin_y, origin_x = atlas
+    (height, width) = frame_shape[:2]
+    (rows, cols) = char_indices.shape
+
+    # Glyphs bigger than cell overlap their neighbours, so cells are drawn in
+    # interleaved groups where glyphs of one group never overlap each other
+    step_y = max(1, -(-glyphs.shape[1] // distance))
+    step_x = max(1, -(-glyphs.shape[2] // distance))
+    block_h = step_y * distance
+    block_w = step_x * distance
+    glyphs = np.pad(glyphs, ((0, 0), (0, block_h - glyphs.shape[1]), (0, block_w - glyphs.shape[2])))
+
+    # Frame is padded so tiles starting above and left of it still fit
+    pad_y = max(origin_y, 0)
+    pad_x = max(origin_x, 0)
+    canvas_h = pad_y + max(height, rows * distance + block_h)
+    canvas_w = pad_x + max(width, cols * distance + block_w)
+    canvas = np.zeros((canvas_h, canvas_w, 3), np.uint8)
+    coverage = np.zeros((canvas_h, canvas_w), np.uint8)
+
+    for group_x in range(step_x):
+        for group_y in range(step_y):
+            group_chars = char_indices[group_y::step_y, group_x::step_x]
+            (group_rows, group_cols) = group_chars.shape
+
+            if group_rows == 0 or group_cols == 0:
+                continue
+
+            alpha = glyphs[group_chars].transpose(0, 2, 1, 3).reshape(group_rows * block_h, group_cols * block_w)
+            color = cv2.resize(
+                np.ascontiguousarray(cell_colors[group_y::step_y, group_x::step_x]),
+                (alpha.shape[1], alpha.shape[0]),
+                interpolation=cv2.INTER_NEAREST,
+            )
+            color = cv2.multiply(color, cv2.cvtColor(alpha, cv2.COLOR_GRAY2BGR), scale=1 / 255)
+
+            top = pad_y - origin_y + group_y * distance
+            left = pad_x - origin_x + group_x * distance
+            bottom = top + alpha.shape[0]
+            right = left + alpha.shape[1]
+            cv2.max(canvas[top:bottom, left:right], color, dst=canvas[top:bottom, left:right])
+            cv2.max(coverage[top:bottom, left:right], alpha, dst=coverage[top:bottom, left:right])
+
+    return (
+        canvas[pad_y: pad_y + height, pad_x: pad_x + width].copy(),
+        coverage[pad_y: pad_y + height, pad_x: pad_x + width].copy(),
+    )
+
+
 def ascii_paint_zoom(input_frame, font_size, ascii_distance_value, ascii_thickness_value, blur_value):
     # font_size /= 10
     if ascii_distance_value < 20:
@@ -1503,29 +1719,18 @@ def ascii_paint_zoom(input_frame, font_size, ascii_distance_value, ascii_thickne
     font_size = ascii_distance_value / font_size / 4
     input_frame = cv2.GaussianBlur(input_frame, (blur_value, blur_value), blur_value)
 
-    blk = np.zeros(input_frame.shape, np.uint8)
-
     render_str = "abcdefghkmnopqstuwxyz"
     if (ascii_distance_value > 3):
-        for xx in range(0, input_frame.shape[1], ascii_distance_value):
-            for yy in range(0, input_frame.shape[0], ascii_distance_value):
-                char = randint(0, 1)
-                pixel_b, pixel_g, pixel_r = input_frame[yy, xx]
-                avg_brightness = sum([pixel_b, pixel_g, pixel_r]) / 3
-                position = int(avg_brightness / 255 * 20)
-
-                char = render_str[randint(0, len(render_str)) - 1]
-                char = render_str[position]
-                cv2.putText(
-                    blk,
-                    str(char),
-                    (xx, yy),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    font_size,
-                    (int(pixel_b), int(pixel_g), int(pixel_r)),
-                    ascii_thickness_value,
-                    lineType=cv2.LINE_AA,
-                )
+        cell_colors = input_frame[::ascii_distance_value, ::ascii_distance_value]
+        char_indices = (cell_colors.sum(axis=2) / 3 / 255 * 20).astype(int)
+
+        blk, coverage = paint_glyph_grid(
+            input_frame.shape,
+            char_indices,
+            cell_colors,
+            ascii_distance_value,
+            get_glyph_atlas(render_str, font_size, ascii_thickness_value),
+        )
     else:
         blk = input_frame
 
@@ -1536,32 +1741,21 @@ def ascii_paint(input_frame, font_size, ascii_distance_value, ascii_thickness_va
     font_size /= 10
     input_frame = cv2.GaussianBlur(input_frame, (blur_value, blur_value), blur_value)
 
-    blk = np.zeros(input_frame.shape, np.uint8)
-
     render_str = "abcdefghkmnopqstuwxyz"
+    cell_colors = input_frame[::ascii_distance_value, ::ascii_distance_value]
 
-    for xx in range(0, input_frame.shape[1], ascii_distance_value):
-        for yy in range(0, input_frame.shape[0], ascii_distance_value):
-            char = randint(0, 1)
-            pixel_b, pixel_g, pixel_r = input_frame[yy, xx]
-            avg_brightness = sum([pixel_b, pixel_g, pixel_r]) / 3
-            position = int(avg_brightness / 255 * 20)
-
-            if (attach_to_color):
-                char = render_str[position]
-            else:
-                char = render_str[randint(0, len(render_str)) - 1]
+    if (attach_to_color):
+        char_indices = (cell_colors.sum(axis=2) / 3 / 255 * 20).astype(int)
+    else:
+        char_indices = np.random.randint(0, len(render_str), cell_colors.shape[:2])
 
-            cv2.putText(
-                blk,
-                str(char),
-                (xx, yy),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                font_size,
-                (int(pixel_b), int(pixel_g), int(pixel_r)),
-                ascii_thickness_value,
-                lineType=cv2.LINE_AA,
-            )
+    blk, coverage = paint_glyph_grid(
+        input_frame.shape,
+        char_indices,
+        cell_colors,
+        ascii_distance_value,
+        get_glyph_atlas(render_str, font_size, ascii_thickness_value),
+    )
 
     return blk
 
@@ -1580,11 +1774,8 @@ def cartoon_effect(input_frame,
 
     if blur_value % 2 == 0:
         blur_value += 1
-        input_frame = cv2.GaussianBlur(input_frame, (blur_value, blur_value), blur_value)
-    else:
-        input_frame = cv2.GaussianBlur(input_frame, (blur_value, blur_value), blur_value)
 
-    input_frame = cv2.Canny(input_frame, canny_thres, canny_thres2)
+    input_frame = get_edge_map(input_frame, blur_value, canny_thres, canny_thres2)[1]
     # input_frame = auto_canny(input_frame)
     input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2BGR)
     kernel = np.ones((line_thickness, line_thickness), np.uint8)
@@ -1594,7 +1785,7 @@ def cartoon_effect(input_frame,
     # frame_copy = cv2.GaussianBlur(frame_copy, (3, 3), 2)
     input_frame = frame_copy
     input_frame = sharpening(input_frame, sharpen, sharpen2)
-    input_frame = denoise(input_frame, denoise_value, denoise_value2)
+    input_frame = denoise(input_frame, denoise_value, denoise_value2, "cartoon_effect")
     input_frame = cv2.GaussianBlur(input_frame, (3, 3), 1)
 
     return input_frame
@@ -1613,12 +1804,9 @@ def pencil_drawer(input_frame,
 
     if blur_value % 2 == 0:
         blur_value += 1
-        input_frame = cv2.GaussianBlur(input_frame, (blur_value, blur_value), blur_value)
-    else:
-        input_frame = cv2.GaussianBlur(input_frame, (blur_value, blur_value), blur_value)
 
     # main_frame = morph_edge_detection(main_frame)
-    input_frame = cv2.Canny(input_frame, canny_thres, canny_thres2)
+    input_frame = get_edge_map(input_frame, blur_value, canny_thres, canny_thres2)[1]
     input_frame = cv2.cvtColor(input_frame, cv2.COLOR_GRAY2BGR)
     kernel = np.ones((line_thickness, line_thickness), np.uint8)
     input_frame = cv2.dilate(input_frame, kernel, iterations=1)
@@ -1627,7 +1815,7 @@ def pencil_drawer(input_frame,
     # frame_copy = cv2.GaussianBlur(frame_copy, (3, 3), 2)
     input_frame = frame_copy
     input_frame = sharpening(input_frame, sharpen, sharpen2)
-    input_frame = denoise(input_frame, denoise_value, denoise_value2)
+    input_frame = denoise(input_frame, denoise_value, denoise_value2, "pencil_drawer")
     # input_frame = np.bitwise_not(input_frame)
 
     return input_frame
@@ -1638,52 +1826,146 @@ def two_colored(input_frame, sharpen, sharpen2, denoise_value, denoise_value2):
     frame_copy = limit_colors_kmeans(frame_copy, 2)
     input_frame = frame_copy
     input_frame = sharpening(input_frame, sharpen, sharpen2)
-    input_frame = denoise(input_frame, denoise_value, denoise_value2)
+    input_frame = denoise(input_frame, denoise_value, denoise_value2, "two_colored")
     return input_frame
 
-def sobel(input_frame, denoise_value, denoise_value2, sharpen, sharpen2, sobel_value):
-    input_frame = denoise(input_frame, denoise_value, denoise_value2)
+def sobel(input_frame, denoise_value, denoise_value2, sharpen, sharpen2, sobel_value, sobel_mode="SOBEL"):
+    # SOBEL: average of x and y derivatives, MAGNITUDE: Sobel gradient magnitude,
+    # SCHARR: Scharr gradient magnitude, ignores sobel_value
+    input_frame = denoise(input_frame, denoise_value, denoise_value2, "sobel")
     input_frame = sharpening(input_frame, sharpen, sharpen2)
-    grad_x = cv2.Sobel(input_frame, cv2.CV_64F, 1, 0, ksize=sobel_value)
-    grad_y = cv2.Sobel(input_frame, cv2.CV_64F, 0, 1, ksize=sobel_value)
-    input_frame = cv2.addWeighted(grad_x, 0.5, grad_y, 0.5, 0)
+
+    if sobel_mode == "SCHARR":
+        grad_x = cv2.Scharr(input_frame, cv2.CV_32F, 1, 0)
+        grad_y = cv2.Scharr(input_frame, cv2.CV_32F, 0, 1)
+        return cv2.convertScaleAbs(cv2.magnitude(grad_x, grad_y))
+
+    if sobel_mode == "MAGNITUDE":
+        grad_x = cv2.Sobel(input_frame, cv2.CV_32F, 1, 0, ksize=sobel_value)
+        grad_y = cv2.Sobel(input_frame, cv2.CV_32F, 0, 1, ksize=sobel_value)
+        return cv2.convertScaleAbs(cv2.magnitude(grad_x, grad_y))
+
+    # Derivatives of kernels up to 5x5 fit into int16
+    depth = cv2.CV_16S if sobel_value <= 5 else cv2.CV_32F
+    grad_x = cv2.Sobel(input_frame, depth, 1, 0, ksize=sobel_value)
+    grad_y = cv2.Sobel(input_frame, depth, 0, 1, ksize=sobel_value)
+    input_frame = cv2.convertScaleAbs(cv2.addWeighted(grad_x, 0.5, grad_y, 0.5, 0))
+
     return input_frame
 
 
+def get_sharpening_kernel(kernel_value):
+    # 3x3 kernel with kernel_value in center, other cells shifted so kernel sums to 1
+    if kernel_value not in sharpening_kernels:
+        kernel_diff = 9 - kernel_value
+        kernel_sharpening = np.array([[-1, -1, -1], [-1, kernel_value, -1], [-1, -1, -1]])
+
+        while kernel_diff != 0:
+            for i in range(3):
+                for j in range(3):
+                    if i == 1 and j == 1:
+                        kernel_sharpening[j][i] == kernel_value
+                    else:
+                        if kernel_diff > 0:
+                            kernel_sharpening[j][i] += 1
+                            kernel_diff -= 1
+                        if kernel_diff < 0:
+                            kernel_sharpening[j][i] -= 1
+                            kernel_diff += 1
+                        if kernel_diff == 0:
+                            break
+
+        sharpening_kernels[kernel_value] = kernel_sharpening
+
+    return sharpening_kernels[kernel_value]
+
+
+def set_sharpen_mode(mode):
+    # DETAIL: kernel and detailEnhance, KERNEL: kernel only, UNSHARP: unsharp mask
+    global sharpen_mode
+    sharpen_mode = mode
+
+
+def detail_enhance_downscaled(input_frame, sigma_s, sigma_r):
+    # detailEnhance on frame downscaled to about 960px width, only its detail layer is upscaled back
+    scale = input_frame.shape[1] // 960
+
+    if scale < 2:
+        return cv2.detailEnhance(input_frame, sigma_s=sigma_s, sigma_r=sigma_r)
+
+    (h, w) = input_frame.shape[:2]
+    guide = cv2.resize(input_frame, (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+    enhanced = cv2.detailEnhance(guide, sigma_s=min(200, sigma_s / scale), sigma_r=sigma_r)
+    detail = cv2.subtract(enhanced, guide, dtype=cv2.CV_16S)
+    detail = cv2.resize(detail, (w, h), interpolation=cv2.INTER_LINEAR)
+
+    return cv2.add(input_frame, detail, dtype=cv2.CV_8U)
+
+
 def sharpening(input_frame, sharpening_value, sharpening_value2):
-    kernel_value = sharpening_value2
-    kernel_diff = 9 - kernel_value
-    kernel_sharpening = np.array([[-1, -1, -1], [-1, kernel_value, -1], [-1, -1, -1]])
-
-    while kernel_diff != 0:
-        for i in range(3):
-            for j in range(3):
-                if i == 1 and j == 1:
-                    kernel_sharpening[j][i] == kernel_value
-                else:
-                    if kernel_diff > 0:
-                        kernel_sharpening[j][i] += 1
-                        kernel_diff -= 1
-                    if kernel_diff < 0:
-                        kernel_sharpening[j][i] -= 1
-                        kernel_diff += 1
-                    if kernel_diff == 0:
-                        break
-
-    input_frame = cv2.filter2D(input_frame, -1, kernel_sharpening)
-
-    input_frame = cv2.detailEnhance(input_frame, sigma_s=sharpening_value, sigma_r=0.15)
+    if sharpen_mode == "UNSHARP":
+        amount = sharpening_value / 20
+        blurred = cv2.GaussianBlur(input_frame, (0, 0), 1 + sharpening_value2 / 20)
+
+        return cv2.addWeighted(input_frame, 1 + amount, blurred, -amount, 0)
+
+    input_frame = cv2.filter2D(input_frame, -1, get_sharpening_kernel(sharpening_value2))
+
+    # detailEnhance does nothing with zero sigma_s
+    if sharpen_mode == "DETAIL" and sharpening_value > 0:
+        input_frame = detail_enhance_downscaled(input_frame, sharpening_value, 0.15)
 
     return input_frame
 
 
-def denoise(input_frame, denoise_value, denoise_value2):
+def set_denoise_source(source_mode):
+    # Video files are denoised across frames, live sources with fast single frame filter
+    global denoise_mode
+    denoise_mode = {"video": "temporal", "youtube": "fast", "ipcam": "fast"}.get(source_mode, "single")
+
+
+def denoise_temporal(input_frame, denoise_value2, history_key):
+    # Motion-compensated recursive filter: previous output is warped onto frame with optical flow
+    # and averaged with it where they still match, moving and uncovered areas get bilateral filter only
+    spatial = cv2.bilateralFilter(input_frame, 5, denoise_value2, 5)
+    gray = cv2.cvtColor(input_frame, cv2.COLOR_BGR2GRAY)
+
+    # Weight of previous output falls to 0 when difference reaches denoise strength
+    weight_lut = 0.8 * np.clip(1 - np.arange(256, dtype=np.float32) / denoise_value2, 0, 1)
+
+    with denoise_lock:
+        history = denoise_history.get(history_key)
+
+        if history is None or history["frame"].shape != input_frame.shape:
+            (h, w) = gray.shape
+            history = {
+                "flow": cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST),
+                "grid": np.dstack(np.meshgrid(np.arange(w), np.arange(h))).astype(np.float32),
+            }
+            output_frame = spatial
+        else:
+            flow = history["flow"].calc(gray, history["gray"], None)
+            warped = cv2.remap(history["frame"], history["grid"] + flow, None, cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+            weight = weight_lut[cv2.absdiff(warped, spatial).max(axis=2)]
+            output_frame = cv2.blendLinear(warped, spatial, weight, 1 - weight)
+
+        history["frame"] = output_frame
+        history["gray"] = gray
+        denoise_history[history_key] = history
+
+    return output_frame
+
+
+def denoise(input_frame, denoise_value, denoise_value2, history_key="denoise"):
+    # history_key separates frame history of each mode using temporal denoise
     if denoise_value2 > 0:
-        b, g, r = cv2.split(input_frame)  # get b,g,r
-        input_frame = cv2.merge([r, g, b])  # switch it to rgb
-        dst = cv2.fastNlMeansDenoisingColored(input_frame, None, denoise_value2, denoise_value, 7, 15)
-        b, g, r = cv2.split(dst)
-        input_frame = cv2.merge([r, g, b])
+        if denoise_mode == "temporal":
+            input_frame = denoise_temporal(input_frame, denoise_value2, history_key)
+        elif denoise_mode == "fast":
+            input_frame = cv2.bilateralFilter(input_frame, 5, denoise_value2, 5)
+        else:
+            input_frame = cv2.fastNlMeansDenoisingColored(input_frame, None, denoise_value2, denoise_value, 7, 15)
 
     return input_frame
 
@@ -1715,27 +1997,112 @@ def morph_edge_detection(input_frame):
     return image_channels
 
 
+def palette_distances(colors, palette):
+    # Squared LAB distances from every color to every palette color
+    colors = colors.astype(np.float32)
+    palette = palette.astype(np.float32)
+
+    return (colors * colors).sum(axis=1)[:, None] - 2 * colors @ palette.T + (palette * palette).sum(axis=1)
+
+
+def reset_palette_cache():
+    # Palette of last scene is not a good start for frames after seek or from other source
+    with palette_lock:
+        palette_cache.clear()
+
+
+def fit_palette(samples, color_count, previous_palette=None):
+    # Fit LAB palette on pixel samples, starting from previous palette keeps colors stable between frames
+    # Fixed seed gives same palette for same frame in every process
+    if previous_palette is not None:
+        clt = MiniBatchKMeans(n_clusters=color_count, init=previous_palette.astype(np.float64), n_init=1,
+                              random_state=0)
+    else:
+        clt = MiniBatchKMeans(n_clusters=color_count, random_state=0)
+
+    clt.fit(samples)
+    palette = clt.cluster_centers_.astype("uint8")
+
+    # Nearest palette color for every 8x8x8 cell of LAB cube
+    grid = np.arange(4, 256, 8)
+    cells = np.stack(np.meshgrid(grid, grid, grid, indexing="ij"), axis=-1).reshape(-1, 3)
+    lut = palette_distances(cells, palette).argmin(axis=1)
+    palette_bgr = cv2.cvtColor(palette.reshape(1, -1, 3), cv2.COLOR_LAB2BGR).reshape(-1, 3)
+    error = np.sqrt(np.maximum(palette_distances(samples, palette).min(axis=1), 0)).mean()
+
+    return {"palette": palette, "palette_bgr": palette_bgr, "lut": lut, "error": error}
+
+
 def limit_colors_kmeans(input_frame, color_count):
     if color_count > 0:
         (h, w) = input_frame.shape[:2]
         input_frame = cv2.cvtColor(input_frame, cv2.COLOR_BGR2LAB)
-        input_frame = input_frame.reshape(
-            (input_frame.shape[0] * input_frame.shape[1], 3)
-        )
-        clt = MiniBatchKMeans(n_clusters=color_count)
-        labels = clt.fit_predict(input_frame)
-        quant = clt.cluster_centers_.astype("uint8")[labels]
-        quant = quant.reshape((h, w, 3))
-        input_frame = input_frame.reshape((h, w, 3))
-        quant = cv2.cvtColor(quant, cv2.COLOR_LAB2BGR)
-        input_frame = cv2.cvtColor(input_frame, cv2.COLOR_LAB2BGR)
-        input_frame = quant
+
+        # About 20000 pixels are enough to fit and check palette
+        step = max(1, int(np.sqrt(h * w / 20000)))
+        samples = input_frame[::step, ::step].reshape(-1, 3)
+
+        # Palette is reused until scene colors drift away from it
+        with palette_lock:
+            cached = palette_cache.get(color_count)
+
+        if cached is None:
+            cached = fit_palette(samples, color_count)
+        else:
+            error = np.sqrt(np.maximum(palette_distances(samples, cached["palette"]).min(axis=1), 0)).mean()
+
+            if error > max(cached["error"], 1) * palette_drift_threshold:
+                cached = fit_palette(samples, color_count, cached["palette"])
+
+        with palette_lock:
+            palette_cache[color_count] = cached
+
+        cells = (input_frame >> 3).astype(np.int32)
+        labels = cached["lut"][(cells[:, :, 0] << 10) | (cells[:, :, 1] << 5) | cells[:, :, 2]]
+        input_frame = cached["palette_bgr"][labels]
 
     return input_frame
 
 
+def reset_edge_maps():
+    # Called before each frame is rendered in this thread, edge maps are kept only for one frame
+    edge_maps.maps = {}
+
+
+def get_edge_map(input_frame, blur_value=0, canny_thres1=None, canny_thres2=None):
+    # Blurred frame and its canny edges, computed once per frame for every parameter set
+    # and shared by all modes and boxes, None thresholds are picked from median like auto_canny
+    # Cache is cleared by reset_edge_maps, so it doesn't depend on frame object identity
+    if not hasattr(edge_maps, "maps"):
+        reset_edge_maps()
+
+    key = (input_frame.shape, blur_value, canny_thres1, canny_thres2)
+
+    if key not in edge_maps.maps:
+        blurred = input_frame
+
+        if blur_value > 0:
+            blurred = cv2.GaussianBlur(input_frame, (blur_value, blur_value), blur_value)
+
+        if canny_thres1 is None:
+            edges = auto_canny(blurred)
+        else:
+            edges = cv2.Canny(blurred, canny_thres1, canny_thres2)
+
+        edge_maps.maps[key] = (blurred, edges)
+
+    return edge_maps.maps[key]
+
+
+def histogram_median(image):
+    # Median of uint8 image from its histogram, without sorting pixels
+    image = np.ascontiguousarray(image).reshape(-1, 1)
+    counts = np.cumsum(cv2.calcHist([image], [0], None, [256], [0, 256]).ravel())
+    return np.searchsorted(counts, (counts[-1] + 1) // 2)
+
+
 def auto_canny(image: object, sigma: object = 0.33) -> object:
-    v = np.median(image)
+    v = histogram_median(image)
     lower = int(max(0, (1.0 - sigma) * v))
     upper = int(min(255, (1.0 + sigma) * v))
     edged = cv2.Canny(image, lower, upper)
@@ -1752,29 +2119,28 @@ def adjust_gamma(image, gamma=1.0):
     return cv2.LUT(image, table)
 
 
-def adjust_saturation(input_frame, saturation=1):
-    saturation = saturation / 100
-    hsv = cv2.cvtColor(input_frame, cv2.COLOR_BGR2HSV)
-    hsv[:, :, 1] = cv2.multiply(hsv[:, :, 1], saturation)
-    hsv[:, :, 2] = cv2.multiply(hsv[:, :, -1], 1)
-    input_frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-    return input_frame
-
-
-def adjust_br_contrast(input_frame, contrast_value, brightness_value):
+def adjust_colors(input_frame, contrast_value, brightness_value, saturation_value):
+    # Contrast scales BGR channels, brightness is added to HSV value and saturation multiplies HSV saturation
+    # All three are lookup tables, so frame is converted to HSV only once and not at all for neutral sliders
     contrast_value = contrast_value / 100
-    alpha = 1  # Contrast control (1.0-3.0)
-    beta = 0  # Brightness control (0-100)
-    input_frame = cv2.convertScaleAbs(
-        input_frame, alpha=contrast_value, beta=0
-    )
-
-    hsv = cv2.cvtColor(input_frame, cv2.COLOR_BGR2HSV)
-    h, s, v = cv2.split(hsv)
-    v = cv2.add(v, brightness_value)
-    v[v > 255] = 255
-    v[v < 0] = 0
-    final_hsv = cv2.merge((h, s, v))
-    input_frame = cv2.cvtColor(final_hsv, cv2.COLOR_HSV2BGR)
+    saturation_value = saturation_value / 100
+
+    # Float frames (Sobel) are converted to uint8 here, like convertScaleAbs did before
+    if input_frame.dtype != np.uint8:
+        input_frame = cv2.convertScaleAbs(input_frame, alpha=contrast_value, beta=0)
+    elif contrast_value != 1:
+        contrast_lut = np.clip(np.round(np.arange(256) * contrast_value), 0, 255).astype(np.uint8)
+        input_frame = cv2.LUT(input_frame, contrast_lut)
+
+    if brightness_value != 0 or saturation_value != 1:
+        values = np.arange(256)
+        hsv_lut = np.dstack((
+            values,
+            np.clip(np.round(values * saturation_value), 0, 255),
+            np.clip(values + brightness_value, 0, 255),
+        )).astype(np.uint8)
+
+        hsv = cv2.cvtColor(input_frame, cv2.COLOR_BGR2HSV)
+        input_frame = cv2.cvtColor(cv2.LUT(hsv, hsv_lut), cv2.COLOR_HSV2BGR)
 
     return input_frame
@@ -0,0 +1,159 @@
+import threading
+import queue
+
+
+class FramePipeline:
+    """
+    Runs items from a source function through a chain of stages on worker threads.
+    Stages are connected with bounded queues, results come out in source order.
+    """
+
+    def __init__(self, source, stages, queue_size=4):
+        """
+        :param source: function returning next item or None at the end of stream
+        :param stages: list of (function, workers_count) pairs, each function maps item to item
+        :param queue_size: max items waiting in front of each stage
+        """
+        self.source = source
+        self.working_on = True
+        self.finished = False
+        self.error = None
+        self.queues = [queue.Queue(queue_size) for i in range(len(stages) + 1)]
+        self.next_sequence = [0 for i in range(len(stages))]
+        self.turns = [threading.Condition() for i in range(len(stages))]
+        self.threads = [threading.Thread(target=self._run_thread, args=(self._read_source,))]
+
+        for stage_index, (function, workers_count) in enumerate(stages):
+            for i in range(max(1, workers_count)):
+                self.threads.append(
+                    threading.Thread(target=self._run_thread, args=(self._run_stage, stage_index, function))
+                )
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def get(self):
+        """
+        Waits for next processed item
+        :return: item in source order or None when stream is over
+        """
+        if self.finished:
+            return None
+
+        sequence_item = self._get(self.queues[-1])
+
+        if self.error is not None:
+            raise self.error
+
+        if sequence_item is None or sequence_item[1] is None:
+            self.finished = True
+            return None
+
+        return sequence_item[1]
+
+    def stop(self):
+        """
+        Stops all threads and drops items in progress
+        :return:
+        """
+        self.working_on = False
+        self.finished = True
+
+        for turn in self.turns:
+            with turn:
+                turn.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+    def _run_thread(self, target, *args):
+        # Error in any thread stops whole pipeline, so other threads, stop() and get() don't wait for it
+        try:
+            target(*args)
+        except BaseException as error:
+            self._fail(error)
+            raise
+
+    def _read_source(self):
+        sequence = 0
+
+        while self.working_on:
+            try:
+                item = self.source()
+            except Exception as error:
+                self._fail(error)
+                return
+
+            if not self._put(self.queues[0], (sequence, item)):
+                return
+            if item is None:
+                return
+
+            sequence += 1
+
+    def _run_stage(self, stage_index, function):
+        in_queue = self.queues[stage_index]
+        out_queue = self.queues[stage_index + 1]
+        turn = self.turns[stage_index]
+
+        while self.working_on:
+            sequence_item = self._get(in_queue)
+
+            if sequence_item is None:
+                return
+
+            sequence, item = sequence_item
+
+            if item is not None:
+                try:
+                    item = function(item)
+                except Exception as error:
+                    self._fail(error)
+                    return
+
+            # Hand results to next stage in source order
+            with turn:
+                while self.working_on and self.next_sequence[stage_index] < sequence:
+                    turn.wait(0.1)
+
+                if not self.working_on:
+                    return
+
+                if self.next_sequence[stage_index] == sequence:
+                    if not self._put(out_queue, (sequence, item)):
+                        return
+                    self.next_sequence[stage_index] += 1
+                    turn.notify_all()
+
+            # End of stream, pass the marker to other workers of this stage
+            if item is None:
+                self._put(in_queue, sequence_item)
+                return
+
+    def _fail(self, error):
+        self.error = error
+        self.working_on = False
+
+        for turn in self.turns:
+            with turn:
+                turn.notify_all()
+
+    def _put(self, target_queue, sequence_item):
+        while self.working_on:
+            try:
+                target_queue.put(sequence_item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _get(self, source_queue):
+        while self.working_on:
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        return None
@@ -0,0 +1,318 @@
+import os
+import shutil
+import subprocess
+import multiprocessing
+import cv2
+from effect_workers import SharedFrameRing
+
+
+def find_keyframes(source_path):
+    """
+    Finds keyframe numbers of video file with ffprobe
+    :param source_path: path to video file
+    :return: list of keyframe numbers, empty if ffprobe is not installed
+    """
+    if shutil.which("ffprobe") is None:
+        return []
+
+    try:
+        output = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "packet=flags",
+                "-of",
+                "csv=print_section=0",
+                source_path,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout.decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    return [i for i, flags in enumerate(output.split()) if flags.startswith("K")]
+
+
+def split_frame_ranges(total_frames, segments_count, keyframes):
+    """
+    Splits video into frame ranges of about equal length, starting at keyframes if known
+    :param total_frames: number of frames in video
+    :param segments_count: number of ranges wanted
+    :param keyframes: keyframe numbers from find_keyframes
+    :return: list of (start_frame, end_frame) pairs, end_frame excluded
+    """
+    starts = [0]
+
+    for k in range(1, segments_count):
+        start = round(k * total_frames / segments_count)
+
+        # Seeking is cheapest from keyframe
+        if len(keyframes) > 0:
+            start = min(keyframes, key=lambda keyframe: abs(keyframe - start))
+
+        if starts[-1] < start < total_frames:
+            starts.append(start)
+
+    return list(zip(starts, starts[1:] + [total_frames]))
+
+
+def initialize_mode_networks(modes_ajax, sliders_ajax, superres_model, esrgan_model):
+    """
+    Initializes only networks needed by render modes
+    :return: dictionary of networks for render_with_mode
+    """
+    from mode_selector import (classes, initialize_yolo_network, initialize_rcnn_network, initialize_caffe_network,
+                               initialize_superres_network, initialize_esrgan_network, initialize_dain_network)
+
+    networks = dict.fromkeys(["yolo", "rcnn", "caffe", "superres", "dain", "esrgan", "device", "output_layers"])
+
+    if modes_ajax["using_yolo_network"]:
+        networks["yolo"], layers_names, networks["output_layers"], colors_yolo = initialize_yolo_network(classes)
+    if modes_ajax["using_mask_rcnn_network"]:
+        networks["rcnn"] = initialize_rcnn_network()
+    if modes_ajax["using_caffe_network"]:
+        networks["caffe"] = initialize_caffe_network()
+    if modes_ajax["upscale_opencv"]:
+        networks["superres"] = initialize_superres_network(superres_model)
+    if modes_ajax["upscale_esrgan"]:
+        networks["esrgan"], networks["device"] = initialize_esrgan_network(
+            esrgan_model, int(sliders_ajax["esrganAlphaSliderValue"]) / 100
+        )
+    if modes_ajax["boost_fps_dain"]:
+        networks["dain"] = initialize_dain_network()
+
+    return networks
+
+
+def render_video_segment(segment_index, source_path, output_path, start_frame, end_frame, modes_ajax,
+                         sliders_ajax, superres_model, esrgan_model, fps, frames_done, preview_name,
+                         preview_size, preview_shapes, esrgan_options, dnn_backend):
+    """
+    Worker process: renders frame range of video into separate file
+    """
+    from mode_selector import render_with_mode, EffectWorkerState, set_esrgan_options
+    from device_select import set_dnn_backend
+
+    set_esrgan_options(*esrgan_options)
+    set_dnn_backend(dnn_backend)
+    networks = initialize_mode_networks(modes_ajax, sliders_ajax, superres_model, esrgan_model)
+    preview = SharedFrameRing(len(frames_done), preview_size, preview_name)
+
+    cap = cv2.VideoCapture(source_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    cap2 = cv2.VideoCapture("input_videos/space.webm")
+    writer = None
+    previous_frame = None
+
+    # DAIN interpolates between frame pairs, so it also reads first frame of next segment
+    read_until = end_frame + 1 if modes_ajax["boost_fps_dain"] else end_frame
+
+    for frame_number in range(start_frame, read_until):
+        ret, frame = cap.read()
+
+        if frame is None:
+            break
+
+        ret2, frame_background = cap2.read()
+        f = f1 = None
+
+        if modes_ajax["boost_fps_dain"]:
+            if previous_frame is None:
+                previous_frame = frame
+                continue
+
+            f, f1 = previous_frame, frame
+            previous_frame = frame
+
+        main_frame, frame_boost_sequence, frame_boost_list, classes_index, zipped_images, zip_obj, zip_is_opened = \
+            render_with_mode(modes_ajax, sliders_ajax, frame.copy(), frame_background, f, f1, networks["yolo"],
+                             networks["rcnn"], networks["caffe"], networks["superres"], networks["dain"],
+                             networks["esrgan"], networks["device"], networks["output_layers"], [], None, False,
+                             True, EffectWorkerState, True)
+
+        frames_out = [main_frame]
+
+        # Interpolated frames go from f up to f1, f1 is written by next pair
+        if frame_boost_list is not None:
+            frame_boost_sequence, frame_boost_list = zip(*sorted(zip(frame_boost_sequence, frame_boost_list)))
+            frames_out = frame_boost_list[:-1]
+
+        if writer is None:
+            writer = cv2.VideoWriter(
+                output_path,
+                cv2.VideoWriter_fourcc(*"MJPG"),
+                fps,
+                (main_frame.shape[1], main_frame.shape[0]),
+                True,
+            )
+
+        for frame_out in frames_out:
+            writer.write(frame_out)
+
+        if main_frame.dtype == "uint8" and preview.write(segment_index, main_frame):
+            preview_shapes[segment_index * 3: segment_index * 3 + 3] = list(main_frame.shape)
+
+        frames_done[segment_index] += 1
+
+    if writer is not None:
+        writer.release()
+
+    preview.close()
+
+
+def concatenate_segments(segment_paths, output_path, fps):
+    """
+    Joins rendered segments into one video file
+    Streams are copied with ffmpeg if it is installed, otherwise frames are re-encoded with OpenCV
+    """
+    segment_paths = [path for path in segment_paths if os.path.exists(path)]
+
+    if shutil.which("ffmpeg") is not None:
+        list_path = output_path + ".txt"
+
+        with open(list_path, "w") as list_file:
+            for path in segment_paths:
+                list_file.write(f"file '{os.path.abspath(path)}'\n")
+
+        result = subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path]
+        )
+        os.remove(list_path)
+
+        if result.returncode == 0:
+            return
+
+    writer = None
+
+    for path in segment_paths:
+        cap = cv2.VideoCapture(path)
+
+        while True:
+            ret, frame = cap.read()
+
+            if frame is None:
+                break
+
+            if writer is None:
+                writer = cv2.VideoWriter(
+                    output_path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (frame.shape[1], frame.shape[0]), True
+                )
+
+            writer.write(frame)
+
+        cap.release()
+
+    if writer is not None:
+        writer.release()
+
+
+class SegmentRenderer:
+    """
+    Renders whole video file in parallel: splits it into frame ranges on keyframes,
+    renders every range in own process with own capture and joins encoded segments at the end.
+    """
+
+    def __init__(self, source_path, output_path, total_frames, segments_count, modes_ajax, sliders_ajax,
+                 superres_model, esrgan_model, fps, frame_size, esrgan_options=(0, 0, 1), dnn_backend="auto"):
+        """
+        :param source_path: path to video file
+        :param output_path: path to final video file
+        :param total_frames: number of frames in video
+        :param segments_count: number of worker processes
+        :param modes_ajax: render modes dictionary
+        :param sliders_ajax: render settings dictionary
+        :param superres_model: model name for upscale_opencv mode
+        :param esrgan_model: model name for upscale_esrgan mode
+        :param fps: output video fps
+        :param frame_size: source frame size in bytes for previews
+        :param esrgan_options: arguments of set_esrgan_options for worker processes
+        :param dnn_backend: backend of OpenCV networks in worker processes, see set_dnn_backend
+        """
+        context = multiprocessing.get_context("spawn")
+        frame_ranges = split_frame_ranges(int(total_frames), segments_count, find_keyframes(source_path))
+
+        self.output_path = output_path
+        self.fps = fps
+        self.finished = False
+        self.segment_paths = [f"{output_path}.part{k}.avi" for k in range(len(frame_ranges))]
+        self.frames_done_list = context.Array("i", len(frame_ranges))
+        self.preview_shapes = context.Array("i", len(frame_ranges) * 3)
+        self.preview_ring = SharedFrameRing(len(frame_ranges), frame_size)
+        self.processes = [
+            context.Process(
+                target=render_video_segment,
+                args=(k, source_path, self.segment_paths[k], start_frame, end_frame, modes_ajax, sliders_ajax,
+                      superres_model, esrgan_model, fps, self.frames_done_list, self.preview_ring.memory.name,
+                      frame_size, self.preview_shapes, esrgan_options, dnn_backend),
+                daemon=True,
+            )
+            for k, (start_frame, end_frame) in enumerate(frame_ranges)
+        ]
+
+        for process in self.processes:
+            process.start()
+
+    def frames_done(self):
+        """
+        :return: number of source frames rendered by all segments
+        """
+        return sum(self.frames_done_list)
+
+    def preview(self):
+        """
+        :return: copy of last frame rendered by first unfinished segment, None if nothing rendered yet
+        """
+        for k, process in enumerate(self.processes):
+            shape = tuple(self.preview_shapes[k * 3: k * 3 + 3])
+
+            if shape[0] > 0 and (process.is_alive() or k == len(self.processes) - 1):
+                return self.preview_ring.read(k, shape, "uint8").copy()
+
+        return None
+
+    def is_finished(self):
+        """
+        Joins segments into output file when all processes are done
+        :return: True if output file is ready
+        """
+        if self.finished:
+            return True
+
+        if any(process.is_alive() for process in self.processes):
+            return False
+
+        if any(process.exitcode != 0 for process in self.processes):
+            self.stop()
+            raise RuntimeError("Video segment rendering failed")
+
+        concatenate_segments(self.segment_paths, self.output_path, self.fps)
+        self.stop()
+
+        return True
+
+    def stop(self):
+        """
+        Terminates worker processes and removes segment files
+        :return:
+        """
+        if self.finished:
+            return
+
+        self.finished = True
+
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+        for path in self.segment_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.preview_ring.close(unlink=True)
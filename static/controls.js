@@ -14,6 +14,8 @@ let urlSource = "";
 let mode = "";
 let superresModel = "LAPSRN";
 let esrganModel = "FALCOON";
+let sharpenMode = "DETAIL";
+let sobelMode = "SOBEL";
 
 function callVideoOrImage(value) {
     document.getElementById("selectedVideoOrImageId").value = value;
@@ -43,6 +45,14 @@ function sendEsrganChangeCommand() {
     esrganModel = $("#modelsEsrganId").val();
 }
 
+function sendSharpenModeChange() {
+    sharpenMode = $("#sharpenModeId").val();
+}
+
+function sendSobelModeChange() {
+    sobelMode = $("#sobelModeId").val();
+}
+
 function sendScreenshotCommand() {
     screenshotCommand = true;
 }
@@ -67,7 +77,8 @@ function resetSettings() {
     document.getElementById("asciiIntervalId").value = 10;
     document.getElementById("asciiThicknessId").value = 1;
     document.getElementById("colorCountId").value = 0;
-    document.getElementById("resizeId").value = 1;
+    document.getElementById("resizeId").value = 2160;
+    document.getElementById("colorIntervalId").value = 1;
     document.getElementById("saturationId").value = 100;
     document.getElementById("sharpenId").value = 0;
     document.getElementById("sharpenId2").value = 0;
@@ -178,9 +189,11 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#confidenceIdBlock").show()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
@@ -199,10 +212,12 @@ var myTimer = setInterval(function () {
                 $("#rcnnBlurIdBlock").show()
                 $("#sobelIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#colorCountIdBlock").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#confidenceIdBlock").show()
                 $("#asciiSizeIdBlock").show()
                 $("#asciiIntervalIdBlock").show()
@@ -225,9 +240,11 @@ var myTimer = setInterval(function () {
                 $("#asciiSizeIdBlock").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#cannyThres1IdBlock").show()
@@ -249,10 +266,12 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#cannyThres1IdBlock").show()
                 $("#cannyThres2IdBlock").show()
             }
@@ -272,10 +291,12 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
             }
@@ -295,10 +316,12 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
             }
@@ -318,10 +341,12 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").show()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
             }
@@ -342,9 +367,11 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#cannyThres1IdBlock").show()
                 $("#cannyThres2IdBlock").show()
             }
@@ -365,9 +392,11 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#cannyThres1IdBlock").show()
                 $("#cannyThres2IdBlock").show()
             }
@@ -388,9 +417,11 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
             }
@@ -406,10 +437,12 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#sharpenIdBlock").show()
                 $("#sharpenIdBlock2").show()
                 $("#denoiseIdBlock").show()
@@ -428,10 +461,12 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#sharpenIdBlock").show()
                 $("#sharpenIdBlock2").show()
                 $("#denoiseIdBlock").show()
@@ -453,10 +488,12 @@ var myTimer = setInterval(function () {
                 $("#denoise2IdBlock").hide()
                 $("#sobelIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#colorCountIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
                 $("#asciiSizeIdBlock").show()
                 $("#asciiIntervalIdBlock").show()
                 $("#asciiThicknessIdBlock").show()
@@ -480,12 +517,14 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#downloadObjectsId").hide()
-                $("#resizeIdBlock").hide()
+                $("#resizeIdBlock").show()
+                $("#colorIntervalIdBlock").hide()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
 
                 $("#superresIdBlock").show()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
             }
             // ESRGAN UPSCALER
             if (currentMode == "t") {
@@ -503,12 +542,20 @@ var myTimer = setInterval(function () {
                 $("#asciiSizeIdBlock").hide()
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
-                $("#resizeIdBlock").hide()
+                $("#resizeIdBlock").show()
+                $("#colorIntervalIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").show()
+
+                // Alpha slider blends ESRGAN and PSNR weights, only interpolated model uses it
+                if ($("#modelsEsrganId").val() == "RRDB_INTERP") {
+                    $("#esrganAlphaIdBlock").show()
+                } else {
+                    $("#esrganAlphaIdBlock").hide()
+                }
             }
 
             // ESRGAN UPSCALER
@@ -528,11 +575,13 @@ var myTimer = setInterval(function () {
                 $("#asciiIntervalIdBlock").hide()
                 $("#asciiThicknessIdBlock").hide()
                 $("#resizeIdBlock").hide()
+                $("#colorIntervalIdBlock").hide()
                 $("#downloadObjectsId").hide()
                 $("#cannyThres1IdBlock").hide()
                 $("#cannyThres2IdBlock").hide()
                 $("#superresIdBlock").hide()
                 $("#esrganIdBlock").hide()
+                $("#esrganAlphaIdBlock").hide()
 
             }
 
@@ -640,6 +689,14 @@ var myTimer2 = setInterval(function () {
     var colorCountOutput = document.getElementById("colorCountValue");
     var colorCountSliderValue = colorCountSlider.value;
 
+    var colorIntervalSlider = document.getElementById("colorIntervalId");
+    var colorIntervalOutput = document.getElementById("colorIntervalValue");
+    var colorIntervalSliderValue = colorIntervalSlider.value;
+
+    var esrganAlphaSlider = document.getElementById("esrganAlphaId");
+    var esrganAlphaOutput = document.getElementById("esrganAlphaValue");
+    var esrganAlphaSliderValue = esrganAlphaSlider.value;
+
     outputPosition.innerHTML = positionSlider.value;
     saturationOutput.innerHTML = saturationSlider.value;
     cannyBlurOutput.innerHTML = cannyBlurSlider.value;
@@ -661,6 +718,8 @@ var myTimer2 = setInterval(function () {
     asciiThicknessOutput.innerHTML = asciiThicknessSlider.value;
     resizeOutput.innerHTML = resizeSlider.value;
     colorCountOutput.innerHTML = colorCountSlider.value;
+    colorIntervalOutput.innerHTML = colorIntervalSlider.value;
+    esrganAlphaOutput.innerHTML = esrganAlphaSlider.value;
 
     positionSlider.oninput = function () {
         outputPosition.innerHTML = this.value;
@@ -746,6 +805,14 @@ var myTimer2 = setInterval(function () {
         colorCountOutput.innerHTML = this.value;
     }
 
+    colorIntervalSlider.oninput = function () {
+        colorIntervalOutput.innerHTML = this.value;
+    }
+
+    esrganAlphaSlider.oninput = function () {
+        esrganAlphaOutput.innerHTML = this.value;
+    }
+
     $.ajax({
         type: "POST",
         contentType: "application/json;charset=utf-8",
@@ -774,6 +841,8 @@ var myTimer2 = setInterval(function () {
             asciiThicknessSliderValue,
             resizeSliderValue,
             colorCountSliderValue,
+            esrganAlphaSliderValue,
+            colorIntervalSliderValue,
             videoResetCommand,
             videoStopCommand,
             modeResetCommand,
@@ -782,7 +851,9 @@ var myTimer2 = setInterval(function () {
             urlSource,
             mode,
             superresModel,
-            esrganModel
+            esrganModel,
+            sharpenMode,
+            sobelMode
         }),
         dataType: "json"
     });